@@ -0,0 +1,194 @@
+# asyncio engine for proxy.py: the Listener/Conn/Fwd model on protocols.
+#
+# Each Conn owns two Side protocols (client and server).  A direction is
+# forwarded by writing what one side receives to the other side's transport;
+# the transports' write-buffer water marks pause and resume reading on the
+# opposite side for backpressure.  EOF on one side becomes write_eof() on the
+# other, so each direction half-closes independently, as with Fwd.
+import asyncio
+import time
+
+from ringLog import log
+
+nextConnectionNumber = 0        # each connection is assigned a unique id
+
+
+class Side(asyncio.Protocol):
+    def __init__(self, conn, name):
+        self.conn, self.name = conn, name
+        self.peer = None        # the Side this one forwards to
+        self.transport = None
+        self.inClosed = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        high = self.conn.bufCap
+        transport.set_write_buffer_limits(high=high, low=high // 4)
+
+    def data_received(self, data):
+        self.conn.lastActive = time.monotonic()
+        self.peer.transport.write(data)
+
+    def eof_received(self):
+        self.inClosed = True
+        self.conn.fwdDone(self, self.peer)
+        return True             # keep our own output open (half close)
+
+    def pause_writing(self):    # our output is full: stop reading the peer
+        self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        if not self.peer.inClosed:
+            self.peer.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            log.warning("Forwarder from client %s failing due to error",
+                        self.conn.caddr)
+        self.conn.die()
+
+
+class ClientSide(Side):
+    def __init__(self, listener):
+        global nextConnectionNumber
+        conn = Conn(listener, nextConnectionNumber)
+        nextConnectionNumber += 1
+        super().__init__(conn, f"ToClnt.{conn.connIndex}")
+        conn.client = self
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        conn = self.conn
+        conn.caddr = transport.get_extra_info("peername")
+        conn.backend = backend = conn.listener.balancer.pick(conn.caddr)
+        backend.active += 1
+        log.conn("New connection #%d from %s to %s", conn.connIndex,
+                 conn.caddr, backend)
+        transport.pause_reading()   # until the server side is connected
+        conn.connectTask = asyncio.ensure_future(conn.connect())
+
+
+class Conn:
+    def __init__(self, listener, connIndex):
+        self.listener, self.connIndex = listener, connIndex
+        self.bufCap = listener.bufCap
+        self.client = self.server = self.connectTask = self.backend = None
+        self.caddr = None
+        self.lastActive = time.monotonic()
+        self.idleTimer = None
+        if listener.idleTimeout:
+            self.idleTimer = asyncio.get_running_loop().call_later(
+                listener.idleTimeout, self.checkIdle)
+        self.forwarders = 2     # directions not yet shut down
+        self.dead = False
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        server = Side(self, f"ToSrvr.{self.connIndex}")
+        server.peer = self.client   # it may receive before we resume
+        try:
+            await asyncio.wait_for(
+                loop.create_connection(lambda: server, *self.serverAddress()),
+                self.listener.connectTimeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            log.warning("Connection %d can't reach server: %s",
+                        self.connIndex, str(e) or "timed out")
+            if self.backend.available(time.monotonic()):
+                self.backend.failed()
+            self.die()
+            return
+        if self.dead:           # client left while we were connecting
+            server.transport.close()
+            return
+        self.server = self.client.peer = server
+        self.client.transport.resume_reading()
+
+    def serverAddress(self):    # cached (host, port); the name if unresolved
+        addr = self.backend.address()
+        return addr[1][:2] if addr else self.backend.saddr
+
+    def checkIdle(self):        # idle timer: re-armed unless truly idle
+        idleTimeout = self.listener.idleTimeout
+        idleFor = time.monotonic() - self.lastActive
+        loop = asyncio.get_running_loop()
+        if idleFor < idleTimeout:
+            self.idleTimer = loop.call_later(idleTimeout - idleFor,
+                                             self.checkIdle)
+        else:
+            log.conn("Connection %d idle for %ss, closing", self.connIndex,
+                     idleTimeout)
+            self.die()
+
+    def fwdDone(self, fromSide, toSide):
+        toSide.transport.write_eof()    # sent once the buffer drains
+        self.forwarders -= 1
+        log.conn("Forwarder %s ==> %s from connection %d shutting down",
+                 fromSide.name, toSide.name, self.connIndex)
+        if self.forwarders == 0:
+            self.backend.succeeded()
+            self.die()
+
+    def die(self):
+        if self.dead:
+            return
+        self.dead = True
+        log.conn("Connection %d shutting down", self.connIndex)
+        if self.idleTimer:
+            self.idleTimer.cancel()
+        self.listener.connections.discard(self)
+        if self.backend is not None:
+            self.backend.active -= 1
+        for side in self.client, self.server:
+            if side is not None and side.transport is not None:
+                side.transport.close()  # flushes anything still buffered
+
+
+class Listener:
+    def __init__(self, balancer, bufCap=65536, connectTimeout=None,
+                 idleTimeout=None):
+        self.balancer, self.bufCap = balancer, bufCap
+        self.connectTimeout = connectTimeout or None    # 0 means none
+        self.idleTimeout = idleTimeout
+        self.connections = set()
+        self.server = None
+
+    def protocolFactory(self):
+        side = ClientSide(self)
+        self.connections.add(side.conn)
+        return side
+
+    async def start(self, bindaddr, **kwargs):
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(
+            self.protocolFactory, *bindaddr, reuse_address=True, **kwargs)
+        return self.server
+
+
+async def serve(bindaddr, balancer, bufCap=65536, connectTimeout=None,
+                idleTimeout=None, **kwargs):
+    """Start forwarding bindaddr to the backends chosen by balancer.
+
+    Returns the Listener; its .server is the asyncio Server, so an embedding
+    application can close() it like any other.  Extra keyword arguments go
+    to loop.create_server (e.g. sock= or reuse_port=)."""
+    listener = Listener(balancer, bufCap, connectTimeout, idleTimeout)
+    await listener.start(bindaddr, **kwargs)
+    return listener
+
+
+def run(bindaddr, balancer, bufCap=65536, connectTimeout=None,
+        idleTimeout=None, **kwargs):
+    """Run the proxy until interrupted, preferring uvloop when installed"""
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
+    async def main():
+        listener = await serve(bindaddr, balancer, bufCap, connectTimeout,
+                               idleTimeout, **kwargs)
+        async with listener.server:
+            await listener.server.serve_forever()
+
+    asyncio.run(main())
@@ -0,0 +1,143 @@
+# Backend servers and the strategies that spread connections across them.
+#
+# A Backend counts the connections currently using it and is ejected for an
+# exponentially growing back-off after a failure.  When its name resolves to
+# several addresses, a failure first moves new connections on to the next
+# address; only when every address has failed in a row is it ejected.  A Balancer picks a backend
+# for each new client: round-robin (weighted), least-connections, or a
+# consistent hash of the client's address.
+from bisect import bisect
+from hashlib import md5
+import re
+import time
+
+from ringLog import log
+
+
+class Backend:
+    def __init__(self, host, port, weight=1):
+        self.saddr = (host, port)   # as configured (may be a hostname)
+        self.addrs = []         # (family, sockaddr) records, from resolver.py
+        self.addrIndex = 0      # the record new connections use
+        self.weight = weight
+        self.active = 0         # connections currently using this backend
+        self.failures = 0       # consecutive failures
+        self.ejectedUntil = 0   # time.monotonic() at which to try again
+        self.pool = None        # UpstreamPool, if pre-connecting
+
+    def __str__(self):
+        return f"{self.saddr[0]}:{self.saddr[1]}"
+
+    def available(self, now):
+        return now >= self.ejectedUntil
+
+    def address(self):
+        """(family, sockaddr) to connect to, or None if unresolved"""
+        addrs = self.addrs
+        return addrs[self.addrIndex % len(addrs)] if addrs else None
+
+    def setAddrs(self, addrs):  # new records; stay on the current one if listed
+        current = self.address()
+        self.addrIndex = addrs.index(current) if current in addrs else 0
+        self.addrs = addrs
+
+    def failed(self):
+        self.failures += 1
+        failedAddr = self.address()
+        self.addrIndex += 1
+        if self.failures < len(self.addrs):     # fail over, no ejection
+            log.warning("Backend %s failed at %s, trying %s", self,
+                        failedAddr[1][0], self.address()[1][0])
+            return
+        backoff = min(0.5 * 2 ** (self.failures - max(len(self.addrs), 1)), 60)
+        self.ejectedUntil = time.monotonic() + backoff
+        log.warning("Backend %s failed, ejected for %.1fs", self, backoff)
+
+    def succeeded(self):
+        self.failures = 0
+
+
+def parseBackends(spec):
+    """Parse "host:port[@weight],..." into a list of Backends"""
+    backends = []
+    for item in spec.split(","):
+        m = re.fullmatch(r"\[?([^\]@]+?)\]?:(\d+)(?:@(\d+))?", item.strip())
+        if not m:
+            raise ValueError(f"bad backend {item!r}")
+        host, port, weight = m.group(1), int(m.group(2)), int(m.group(3) or 1)
+        if weight < 1:
+            raise ValueError(f"bad weight in {item!r}")
+        backends.append(Backend(host, port, weight))
+    return backends
+
+
+class Balancer:
+    def __init__(self, backends):
+        self.backends = backends
+
+    def pick(self, caddr):
+        """Backend for a client at caddr, preferring ones not ejected"""
+        now = time.monotonic()
+        live = [b for b in self.backends if b.available(now)]
+        if not live:            # all ejected: try the one back soonest
+            return min(self.backends, key=lambda b: b.ejectedUntil)
+        return self.choose(live, caddr)
+
+
+class RoundRobin(Balancer):
+    # smooth weighted round robin: heavy backends aren't picked in bursts
+    def __init__(self, backends):
+        super().__init__(backends)
+        self.current = {b: 0 for b in backends}
+
+    def choose(self, live, caddr):
+        total = 0
+        for b in live:
+            self.current[b] += b.weight
+            total += b.weight
+        best = max(live, key=self.current.__getitem__)
+        self.current[best] -= total
+        return best
+
+
+class LeastConnections(Balancer):
+    def choose(self, live, caddr):
+        return min(live, key=lambda b: b.active / b.weight)
+
+
+class ConsistentHash(Balancer):
+    # each backend owns pointsPerWeight * weight points on a hash ring; a
+    # client maps to the first live backend clockwise of its address's hash
+    pointsPerWeight = 100
+
+    def __init__(self, backends):
+        super().__init__(backends)
+        ring = []
+        for b in backends:
+            for i in range(self.pointsPerWeight * b.weight):
+                ring.append((self.hash(f"{b}#{i}"), b))
+        ring.sort(key=lambda point: point[0])
+        self.hashes = [h for h, b in ring]
+        self.owners = [b for h, b in ring]
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(md5(key.encode()).digest()[:8], "big")
+
+    def choose(self, live, caddr):
+        if len(live) == 1:
+            return live[0]
+        live = set(live)
+        owners = self.owners
+        start = bisect(self.hashes, self.hash(str(caddr[0])))
+        for i in range(len(owners)):
+            b = owners[(start + i) % len(owners)]
+            if b in live:
+                return b
+
+
+strategies = {
+    "rr": RoundRobin,
+    "leastconn": LeastConnections,
+    "hash": ConsistentHash,
+    }
@@ -0,0 +1,63 @@
+# Process helpers shared by the benchmark scripts.
+#
+# start() runs one of this directory's servers and waits until it accepts
+# connections; procStats() reads a live process's CPU time and RSS from
+# /proc.  raiseFdLimit() lifts the soft descriptor limit to the hard one
+# before servers are started, so they inherit it.
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+clockTicks = os.sysconf("SC_CLK_TCK")
+pageSize = os.sysconf("SC_PAGE_SIZE")
+
+
+def raiseFdLimit():
+    """Raise RLIMIT_NOFILE to its hard limit and return that limit"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def procStats(pid):             # (cpu seconds, rss bytes) of a live process
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return ((int(fields[11]) + int(fields[12])) / clockTicks,
+            int(fields[21]) * pageSize)
+
+
+def cpuSeconds(pid):            # user+system time of a running process
+    return procStats(pid)[0]
+
+
+def rss(pid):
+    return procStats(pid)[1]
+
+
+def start(script, args, port):
+    """Run script (from this directory) and wait until port accepts"""
+    proc = subprocess.Popen([sys.executable, os.path.join(here, script)] + args,
+                            stdout=subprocess.DEVNULL)
+    waitForPort(port, proc)
+    return proc
+
+
+def waitForPort(port, proc):
+    for attempt in range(100):
+        if proc.poll() is not None:
+            raise RuntimeError(f"{proc.args} exited with {proc.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    raise RuntimeError(f"nothing listening on port {port}")
+
+
+def stop(proc):
+    proc.terminate()
+    proc.wait()
@@ -0,0 +1,170 @@
+#! /usr/bin/env python3
+# End-to-end benchmark suite with regression tracking.
+#
+# Starts echoServer.py and, per target, optionally proxy.py or
+# stammerProxy.py in front of it, then runs echoClient.py --bench over a
+# matrix of client counts and payload sizes.  Throughput, latency
+# percentiles and the CPU time and peak RSS of the process under test go to
+# a JSON results file.  Given --baseline, every cell is compared with the
+# stored run and the suite exits non-zero if throughput dropped by more than
+# --threshold.  Cells with errors or unanswered messages are marked invalid
+# rather than compared, and cells needing more file descriptors than the
+# hard limit allows are not run at all.
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchProcs import here, procStats, raiseFdLimit, start, stop
+import params
+
+switchesVarDefaults = (
+    (('-t', '--targets'), 'targets', "direct,proxy"),  # also: stammer, proxy:PROFILE
+    (('-c', '--clients'), 'clients', "1,64,1000,10000"),
+    (('-z', '--sizes'), 'sizes', "64,4096,65536"),  # echoClient --sizes specs
+    (('-D', '--duration'), 'duration', "5"),  # seconds per cell
+    (('-p', '--basePort'), 'basePort', "51000"),
+    (('-a', '--proxyArgs'), 'proxyArgs', "none"),  # extra args for the proxy
+    (('-A', '--stammerArgs'), 'stammerArgs', "none"),  # e.g. "-p dsl -r 1"
+    (('-e', '--echoArgs'), 'echoArgs', "-L warning"),  # e.g. "-w 4 -L warning"
+    (('-o', '--out'), 'out', "bench-results.json"),
+    (('-B', '--baseline'), 'baseline', "none"),  # results file to compare
+    (('-T', '--threshold'), 'threshold', "0.10"),  # allowed throughput drop
+    (('-?', '--usage'), 'usage', False),  # boolean (set if present)
+    )
+
+paramMap = params.parseParams(switchesVarDefaults)
+if paramMap['usage']:
+    params.usage()
+
+try:
+    targets = paramMap['targets'].split(",")
+    clientCounts = [int(c) for c in paramMap['clients'].split(",")]
+    sizeSpecs = paramMap['sizes'].split(",")
+    duration = float(paramMap['duration'])
+    basePort = int(paramMap['basePort'])
+    threshold = float(paramMap['threshold'])
+    proxyArgs = [] if paramMap['proxyArgs'] == "none" else paramMap['proxyArgs'].split()
+    stammerArgs = [] if paramMap['stammerArgs'] == "none" else paramMap['stammerArgs'].split()
+    echoArgs = [] if paramMap['echoArgs'] == "none" else paramMap['echoArgs'].split()
+except:
+    print("Can't parse benchmark parameters")
+    sys.exit(1)
+
+scripts = {"proxy": "proxy.py", "stammer": "stammerProxy.py"}
+for target in targets:
+    # proxy:PROFILE runs the proxy with that socket-option profile both ways
+    script, sep, profile = target.partition(":")
+    if target != "direct" and script not in scripts or sep and script != "proxy":
+        print(f"Unknown target {target}")
+        sys.exit(1)
+
+fdLimit = raiseFdLimit()       # the servers started below inherit it
+
+
+def runCell(port, measured, clients, sizes):
+    """One echoClient --bench run; samples measured (a Popen) meanwhile"""
+    with tempfile.NamedTemporaryFile(suffix=".json") as out:
+        client = subprocess.Popen(
+            [sys.executable, os.path.join(here, "echoClient.py"), "--bench",
+             "-s", f"127.0.0.1:{port}", "-n", str(clients),
+             "-t", str(duration), "-z", sizes, "-j", out.name],
+            stdout=subprocess.DEVNULL)
+        cpuStart, peakRss = procStats(measured.pid)
+        while client.poll() is None:
+            time.sleep(0.2)
+            peakRss = max(peakRss, procStats(measured.pid)[1])
+        cpu = procStats(measured.pid)[0] - cpuStart
+        try:
+            with open(out.name) as f:
+                result = json.load(f)
+        except ValueError:      # client died before writing results
+            result = {"errors": -1, "throughputMBps": 0, "latencyMs": {}}
+    result["cpuSeconds"] = cpu
+    result["peakRssBytes"] = peakRss
+    return result
+
+
+def cellKey(cell):
+    return f"{cell['target']}/{cell['clients']}/{cell['sizes']}"
+
+
+def fits(target, clients):      # enough descriptors for the busiest process?
+    perClient = 1 if target == "direct" else 2  # a proxy holds both ends
+    return (fdLimit == resource.RLIM_INFINITY or
+            perClient * clients + 100 <= fdLimit)
+
+
+def valid(cell):                # only clean runs are worth comparing
+    return cell["errors"] == 0 and not cell.get("unanswered")
+
+
+results = []
+echoPort = basePort + 1
+echo = start("echoServer.py", ["-l", str(echoPort)] + echoArgs, echoPort)
+try:
+    for target in targets:
+        proxy, port = None, echoPort
+        if target != "direct":
+            port = basePort
+            script, sep, profile = target.partition(":")
+            args = proxyArgs if script == "proxy" else stammerArgs
+            if profile:
+                args = args + ["-C", profile, "-O", profile]
+            proxy = start(scripts[script],
+                          ["-l", str(port), "-s", f"127.0.0.1:{echoPort}"]
+                          + args, port)
+        try:
+            for clients in clientCounts:
+                if not fits(target, clients):
+                    print(f"Skipping {target} with {clients} clients:",
+                          f"file descriptor limit {fdLimit} is too low")
+                    continue
+                for sizes in sizeSpecs:
+                    cell = runCell(port, proxy or echo, clients, sizes)
+                    cell.update(target=target, clients=clients, sizes=sizes)
+                    results.append(cell)
+                    lat = cell["latencyMs"]
+                    print(
+                        f"{cellKey(cell):>28}: {cell['throughputMBps']:9.2f} MB/s",
+                        f"p50={lat.get('p50', 0):8.3f}ms p99={lat.get('p99', 0):8.3f}ms",
+                        f"cpu={cell['cpuSeconds']:6.2f}s",
+                        f"rss={cell['peakRssBytes'] >> 20}MiB errors={cell['errors']}",
+                        )
+        finally:
+            if proxy:
+                stop(proxy)
+finally:
+    stop(echo)
+
+with open(paramMap['out'], "w") as f:
+    json.dump({"time": time.time(), "results": results}, f, indent=2)
+print(f"Results written to {paramMap['out']}")
+
+if paramMap['baseline'] != "none":
+    with open(paramMap['baseline']) as f:
+        baseline = {cellKey(c): c for c in json.load(f)["results"]}
+    regressions = invalid = 0
+    for cell in results:
+        old = baseline.get(cellKey(cell))
+        if not valid(cell):
+            print(f"{cellKey(cell):>28}: INVALID (errors or unanswered messages)")
+            invalid += 1
+            continue
+        if not old or not valid(old) or not old["throughputMBps"]:
+            continue
+        change = cell["throughputMBps"] / old["throughputMBps"] - 1
+        flag = ""
+        if change < -threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{cellKey(cell):>28}: {change:+7.1%} vs baseline{flag}")
+    if regressions:
+        print(f"{regressions} cells regressed by more than {threshold:.0%}")
+    if invalid:
+        print(f"{invalid} cells had errors and were not compared")
+    if regressions or invalid:
+        sys.exit(1)
@@ -0,0 +1,85 @@
+# Append-only, memory-mapped capture of proxied streams, for replay.py.
+#
+# A capture file is a header (magic, bytes in use) followed by records:
+#   when    float64   timers.now (time.monotonic()) when the data was read
+#   conn    uint32    connection number, unique within the file
+#   kind    uint8     C2S or S2C data (an empty payload is that direction's
+#                     EOF), OPEN or CLOSE of the connection
+#   length  uint32    payload bytes that follow
+# Records are copied straight into the mapping, so recording one costs no
+# system call; the file is grown (and remapped) in growStep steps up to
+# maxBytes, after which further records are dropped.  The header's length
+# is updated after every record, so a reader sees only whole records even
+# if the writer is killed.  Each process writes its own file.
+import mmap
+import os
+import struct
+
+from ringLog import log
+
+magic = b"PXCAP\0\0\1"
+fileHeader = struct.Struct("<8sQ")       # magic, bytes in use
+usedField = struct.Struct("<Q")
+recordHeader = struct.Struct("<dIBI")    # when, conn, kind, length
+OPEN, CLOSE = 2, 3                       # kinds 0 and 1 are C2S and S2C
+growStep = 64 << 20
+
+
+class CaptureFile:
+    def __init__(self, path, maxBytes=1 << 30):
+        self.path, self.maxBytes = path, max(maxBytes, fileHeader.size)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.size = min(growStep, self.maxBytes)
+        os.ftruncate(self.fd, self.size)    # sparse: costs nothing yet
+        self.mm = mmap.mmap(self.fd, self.size)
+        self.used = fileHeader.size
+        self.full = False
+        fileHeader.pack_into(self.mm, 0, magic, self.used)
+
+    def record(self, when, conn, kind, data=b""):
+        n = len(data)
+        start = self.used + recordHeader.size
+        end = start + n
+        if end > self.size and not self.grow(end):
+            return
+        mm = self.mm
+        recordHeader.pack_into(mm, self.used, when, conn, kind, n)
+        mm[start:end] = data
+        self.used = end
+        usedField.pack_into(mm, 8, end)
+
+    def grow(self, end):
+        if end > self.maxBytes:
+            if not self.full:
+                self.full = True
+                log.warning("Capture file %s is full, no longer recording",
+                            self.path)
+            return False
+        self.size = min(max(self.size + growStep, end), self.maxBytes)
+        self.mm.resize(self.size)   # grows the file too
+        return True
+
+    def close(self):            # trim the unused tail
+        if self.mm:
+            self.mm.close()
+            self.mm = None
+            os.ftruncate(self.fd, self.used)
+            os.close(self.fd)
+
+
+def readCapture(path):
+    """Records of a capture file as (when, conn, kind, payload) tuples.
+
+    Payloads are memoryviews of the mapped file, not copies."""
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    tag, used = fileHeader.unpack_from(mm)
+    if tag != magic:
+        raise ValueError(f"{path} is not a capture file")
+    view = memoryview(mm)
+    offset = fileHeader.size
+    while offset < used:
+        when, conn, kind, n = recordHeader.unpack_from(mm, offset)
+        offset += recordHeader.size
+        yield when, conn, kind, view[offset:offset + n]
+        offset += n
@@ -0,0 +1,415 @@
+# Throughput and latency benchmark behind echoClient.py --bench.
+#
+# Closed loop (run): each client keeps one message in flight: it stamps the
+# first 8 bytes of the payload with the send time, waits for the whole
+# message to be echoed and records the round trip from the stamp it gets
+# back.  Clients run for a fixed duration and then half-close, like the
+# plain echoClient does; a message still not echoed drainTimeout seconds
+# later is counted as unanswered.
+#
+# Open loop (runOpenLoop): messages are due at a fixed total rate, spread
+# round-robin over the connections, and are queued when due whether or not
+# earlier ones have been echoed.  Latency is measured from when a message
+# was due, not when it could be sent, so a stalled server is charged for
+# the whole wait (no coordinated omission).  Messages still unanswered
+# drainTimeout seconds after the run are counted as such.
+#
+# fanOut() runs either in several forked processes, each with its share of
+# the connections (and rate), and merges their Stats.
+from collections import deque
+import json
+from math import ceil
+import os
+import pickle
+import random
+from selectors import EVENT_READ, EVENT_WRITE, DefaultSelector
+from socket import (IPPROTO_TCP, SHUT_WR, SO_ERROR, SOL_SOCKET, TCP_NODELAY,
+                    socket)
+import struct
+import sys
+import time
+import traceback
+
+stamp = struct.Struct("!Q")     # send time in ns, at the start of a message
+drainTimeout = 5.0              # seconds replies may take after the run
+
+
+class SizeDist:
+    """Message sizes: "N", "MIN-MAX" (uniform) or "A,B,..." (equally likely)"""
+    def __init__(self, spec, rng=random):
+        self.spec, self.rng = spec, rng
+        if "-" in spec:
+            self.lo, self.hi = (int(x) for x in spec.split("-"))
+            self.choices = None
+        else:
+            self.choices = [int(x) for x in spec.split(",")]
+            self.lo, self.hi = min(self.choices), max(self.choices)
+        if self.lo < stamp.size or self.hi < self.lo:
+            raise ValueError(f"sizes must be at least {stamp.size} bytes")
+
+    def sample(self):
+        if self.choices:
+            return self.rng.choice(self.choices)
+        return self.rng.randint(self.lo, self.hi)
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = []     # round trips in ns
+        self.messages = self.bytes = self.errors = 0
+        self.unanswered = 0     # sent, never (fully) echoed
+
+    def merge(self, other):
+        self.latencies += other.latencies
+        self.messages += other.messages
+        self.bytes += other.bytes
+        self.errors += other.errors
+        self.unanswered += other.unanswered
+
+
+class BenchClient:
+    def __init__(self, sel, saddr, sizes, stats, recvBuf):
+        self.sel, self.sizes, self.stats = sel, sizes, stats
+        self.recvBuf = recvBuf  # shared scratch buffer; echoes are discarded
+        self.sock = sock = socket()
+        sock.setblocking(False)
+        sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)  # don't add Nagle delay
+        sock.connect_ex(saddr)
+        self.out = None         # unsent rest of the current message
+        self.need = 0           # bytes of the current message not yet echoed
+        self.echoedStamp = bytearray()
+        self.stopping = self.done = False
+        sel.register(sock, EVENT_WRITE, self)
+
+    def nextMessage(self):
+        size = self.sizes.sample()
+        msg = bytearray(size)
+        stamp.pack_into(msg, 0, time.perf_counter_ns())
+        self.out, self.need = memoryview(msg), size
+        self.echoedStamp.clear()
+        self.sel.modify(self.sock, EVENT_READ | EVENT_WRITE, self)
+
+    def doSend(self):
+        if self.out is None:    # connected: start the first message
+            self.nextMessage()
+        try:
+            n = self.sock.send(self.out)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.fail(f"can't send: {e}")
+            return
+        self.out = self.out[n:]
+        if not len(self.out):   # wait for the echo
+            self.sel.modify(self.sock, EVENT_READ, self)
+
+    def doRecv(self):
+        try:
+            n = self.sock.recv_into(self.recvBuf)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.fail(f"can't receive: {e}")
+            return
+        if n == 0:
+            if self.need or not self.stopping:
+                self.fail("server closed mid-message")
+            else:
+                self.finish()
+            return
+        if n > self.need:
+            self.fail("received more than was sent")
+            return
+        if len(self.echoedStamp) < stamp.size:
+            take = min(n, stamp.size - len(self.echoedStamp))
+            self.echoedStamp += self.recvBuf[:take]
+        self.need -= n
+        self.stats.bytes += n
+        if self.need == 0 and not self.out:
+            sent, = stamp.unpack(self.echoedStamp)
+            self.stats.latencies.append(time.perf_counter_ns() - sent)
+            self.stats.messages += 1
+            if self.stopping:
+                self.sock.shutdown(SHUT_WR)
+                self.sel.modify(self.sock, EVENT_READ, self)
+            else:
+                self.nextMessage()
+
+    def stop(self):             # finish the message in flight, then close
+        self.stopping = True
+        if self.done:
+            return
+        if self.out is None:    # never connected: nothing to measure
+            self.finish()
+        elif self.need == 0 and not self.out:
+            try:
+                self.sock.shutdown(SHUT_WR)
+            except OSError:
+                pass
+            self.sel.modify(self.sock, EVENT_READ, self)
+
+    def abandon(self):          # drain deadline passed: give up on the echo
+        if self.need or self.out:
+            self.stats.unanswered += 1
+        self.finish()
+
+    def fail(self, msg):
+        print(f"FAILURE: {msg}")
+        self.stats.errors += 1
+        self.finish()
+
+    def finish(self):
+        self.done = True
+        self.sel.unregister(self.sock)
+        self.sock.close()
+
+
+def run(saddr, concurrency, duration, sizes):
+    """Drive concurrency closed-loop clients against saddr for duration s"""
+    sel = DefaultSelector()
+    stats = Stats()
+    recvBuf = bytearray(1 << 16)
+    clients = [BenchClient(sel, saddr, sizes, stats, recvBuf)
+               for i in range(concurrency)]
+    start = time.perf_counter()
+    deadline = start + duration
+    stopped = False
+    while sel.get_map():
+        now = time.perf_counter()
+        if now >= deadline:
+            if stopped:         # drainTimeout is over: stop waiting
+                for client in clients:
+                    if not client.done:
+                        client.abandon()
+                break
+            stopped = True
+            deadline = now + drainTimeout
+            for client in clients:
+                client.stop()
+            continue
+        for key, mask in sel.select(deadline - now):
+            client = key.data
+            if mask & EVENT_READ and not client.done:
+                client.doRecv()
+            if mask & EVENT_WRITE and not client.done:
+                client.doSend()
+    return stats, time.perf_counter() - start
+
+
+class OpenLoopClient:
+    def __init__(self, sel, saddr, stats, recvBuf):
+        self.sel, self.stats, self.recvBuf = sel, stats, recvBuf
+        self.sock = sock = socket()
+        sock.setblocking(False)
+        sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        sock.connect_ex(saddr)
+        self.connected = self.done = False
+        self.out = deque()      # due messages (or their unsent rest)
+        self.inFlight = deque()     # (due time in ns, size) not yet echoed
+        self.echoed = 0         # bytes of inFlight[0] echoed so far
+        sel.register(sock, EVENT_WRITE, self)
+
+    def request(self, due, size, payload):
+        self.out.append(payload[:size])
+        self.inFlight.append((due, size))
+        if self.connected and len(self.out) == 1:
+            self.sel.modify(self.sock, EVENT_READ | EVENT_WRITE, self)
+
+    def doSend(self):
+        if not self.connected:
+            err = self.sock.getsockopt(SOL_SOCKET, SO_ERROR)
+            if err:
+                self.fail(f"can't connect: {os.strerror(err)}")
+                return
+            self.connected = True
+        out = self.out
+        while out:
+            try:
+                n = self.sock.send(out[0])
+            except BlockingIOError:
+                return
+            except OSError as e:
+                self.fail(f"can't send: {e}")
+                return
+            if n < len(out[0]):
+                out[0] = out[0][n:]
+                return
+            out.popleft()
+        self.sel.modify(self.sock, EVENT_READ, self)
+
+    def doRecv(self):
+        try:
+            n = self.sock.recv_into(self.recvBuf)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.fail(f"can't receive: {e}")
+            return
+        if n == 0:
+            self.fail("server closed the connection")
+            return
+        now = time.perf_counter_ns()
+        inFlight, stats = self.inFlight, self.stats
+        while n and inFlight:
+            due, size = inFlight[0]
+            take = min(n, size - self.echoed)
+            self.echoed += take
+            n -= take
+            if self.echoed == size:
+                inFlight.popleft()
+                self.echoed = 0
+                stats.latencies.append(now - due)
+                stats.messages += 1
+                stats.bytes += size
+        if n:
+            self.fail("received more than was sent")
+
+    def fail(self, msg):
+        print(f"FAILURE: {msg}")
+        self.stats.errors += 1
+        self.finish()
+
+    def finish(self):           # whatever is still in flight went unanswered
+        self.stats.unanswered += len(self.inFlight)
+        self.inFlight.clear()
+        self.done = True
+        self.sel.unregister(self.sock)
+        self.sock.close()
+
+
+def dispatch(sel, timeout):
+    for key, mask in sel.select(timeout):
+        client = key.data
+        if mask & EVENT_READ and not client.done:
+            client.doRecv()
+        if mask & EVENT_WRITE and not client.done:
+            client.doSend()
+
+
+def runOpenLoop(saddr, concurrency, duration, sizes, rate):
+    """Send rate messages/s in all over concurrency connections"""
+    sel = DefaultSelector()
+    stats = Stats()
+    recvBuf = bytearray(1 << 16)
+    payload = memoryview(bytes(sizes.hi))
+    clients = [OpenLoopClient(sel, saddr, stats, recvBuf)
+               for i in range(concurrency)]
+    connectBy = time.perf_counter() + 10
+    while (not all(c.connected or c.done for c in clients) and
+           time.perf_counter() < connectBy):
+        dispatch(sel, 0.1)      # the clock starts once everyone is connected
+    live = [c for c in clients if c.connected and not c.done]
+    interval = 1e9 / rate       # ns between messages
+    start = time.perf_counter_ns()
+    end = start + int(duration * 1e9)
+    issued = failed = 0
+    while live:
+        now = time.perf_counter_ns()
+        if now >= end:
+            break
+        while start + issued * interval <= now:  # send what's due, late or not
+            client = live[issued % len(live)]
+            client.request(start + int(issued * interval), sizes.sample(),
+                           payload)
+            issued += 1
+        wait = (start + issued * interval - time.perf_counter_ns()) / 1e9
+        dispatch(sel, wait if wait > 0.001 else 0)  # select() rounds to ms
+        if stats.errors != failed:  # a client failed: stop scheduling it
+            failed = stats.errors
+            live = [c for c in live if not c.done]
+    elapsed = (time.perf_counter_ns() - start) / 1e9
+    drainBy = time.perf_counter() + drainTimeout
+    while (any(c.inFlight for c in clients if not c.done) and
+           time.perf_counter() < drainBy):
+        dispatch(sel, 0.1)
+    for client in clients:
+        if not client.done:
+            client.finish()
+    return stats, elapsed
+
+
+def fanOut(processes, work):
+    """Run work(i) -> (Stats, elapsed) in processes forked children.
+
+    Returns their merged Stats and the longest elapsed time."""
+    if processes == 1:
+        return work(0)
+    children = []
+    for i in range(processes):
+        r, w = os.pipe()
+        sys.stdout.flush()      # or the child would repeat buffered output
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            status = 0
+            try:
+                result = work(i)
+            except BaseException:
+                traceback.print_exc()
+                result, status = None, 1
+            with os.fdopen(w, "wb") as f:
+                pickle.dump(result, f)
+            sys.stdout.flush()
+            os._exit(status)
+        os.close(w)
+        children.append((pid, r))
+    stats, elapsed = Stats(), 0
+    for pid, r in children:
+        with os.fdopen(r, "rb") as f:
+            try:
+                result = pickle.load(f)
+            except EOFError:
+                result = None
+        os.waitpid(pid, 0)
+        if result is None:
+            print(f"FAILURE: load generator process {pid} failed")
+            stats.errors += 1
+            continue
+        stats.merge(result[0])
+        elapsed = max(elapsed, result[1])
+    return stats, elapsed
+
+
+def percentile(sortedValues, p):  # nearest-rank percentile of sorted values
+    if not sortedValues:
+        return 0
+    rank = max(ceil(p / 100 * len(sortedValues)) - 1, 0)
+    return sortedValues[rank]
+
+
+def summarize(stats, elapsed, **settings):
+    lat = sorted(stats.latencies)
+    ms = 1e-6
+    return dict(
+        settings,
+        elapsed=elapsed,
+        messages=stats.messages,
+        bytes=stats.bytes,
+        errors=stats.errors,
+        unanswered=stats.unanswered,
+        throughputMBps=stats.bytes / elapsed / 1e6,
+        messagesPerSec=stats.messages / elapsed,
+        latencyMs={
+            "min": lat[0] * ms if lat else 0,
+            "mean": sum(lat) / len(lat) * ms if lat else 0,
+            "p50": percentile(lat, 50) * ms,
+            "p90": percentile(lat, 90) * ms,
+            "p99": percentile(lat, 99) * ms,
+            "p99.9": percentile(lat, 99.9) * ms,
+            "max": lat[-1] * ms if lat else 0,
+            },
+        )
+
+
+def report(summary, jsonPath=None):
+    lat = summary["latencyMs"]
+    print(f"{summary['messages']} messages, {summary['bytes']} bytes echoed",
+          f"in {summary['elapsed']:.2f}s ({summary['errors']} errors)")
+    if summary['unanswered']:
+        print(f"{summary['unanswered']} messages never echoed")
+    print(f"throughput: {summary['throughputMBps']:.2f} MB/s,",
+          f"{summary['messagesPerSec']:.0f} messages/s")
+    print("latency ms: " + ", ".join(f"{k}={v:.3f}" for k, v in lat.items()))
+    if jsonPath:
+        with open(jsonPath, "w") as f:
+            json.dump(summary, f, indent=2)
@@ -11,6 +11,12 @@ import params
 switchesVarDefaults = (
     (('-s', '--server'), 'server', "127.0.0.1:50000"),
     (('-n', '--numClients'), 'numClients', "4"),
+    (('-b', '--bench'), 'bench', False),  # timed throughput/latency run
+    (('-t', '--duration'), 'duration', "10"),  # seconds (--bench)
+    (('-z', '--sizes'), 'sizes', "64-4096"),  # N, MIN-MAX or A,B,.. (--bench)
+    (('-j', '--json'), 'json', "none"),  # also write --bench results here
+    (('-r', '--rate'), 'rate', "0"),  # --bench messages/s in all; 0 = closed loop
+    (('-P', '--processes'), 'processes', "1"),  # --bench load generators
     (('-d', '--debug'), 'debug', False),  # boolean (set if present)
     (('-?', '--usage'), 'usage', False),  # boolean (set if present)
     )
@@ -29,6 +35,39 @@ except:
     print(f"Can't parse server:port from {server}")
     sys.exit(1)
 
+if paramMap['bench']:           # numClients concurrent clients
+    import echoBench
+    import resource
+    try:
+        duration = float(paramMap['duration'])
+        sizes = echoBench.SizeDist(paramMap['sizes'])
+        rate = float(paramMap['rate'])
+        processes = int(paramMap['processes'])
+        assert rate >= 0 and 0 < processes <= numClients
+    except Exception as e:
+        print(f"Can't parse benchmark parameters: {e}")
+        sys.exit(1)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    try:                        # one descriptor per client
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        pass
+
+    def work(i):                # process i's share of clients (and rate)
+        share = numClients // processes + (i < numClients % processes)
+        if rate:
+            return echoBench.runOpenLoop((serverHost, serverPort), share,
+                                         duration, sizes, rate / processes)
+        return echoBench.run((serverHost, serverPort), share, duration, sizes)
+    stats, elapsed = echoBench.fanOut(processes, work)
+    summary = echoBench.summarize(stats, elapsed, server=server,
+                                  concurrency=numClients, duration=duration,
+                                  sizes=sizes.spec, rate=rate,
+                                  processes=processes)
+    jsonPath = paramMap['json']
+    echoBench.report(summary, None if jsonPath == "none" else jsonPath)
+    sys.exit(1 if stats.errors else 0)
+
 
 sockNames = {}        # from socket to name
 nextClientNumber = 0  # each client is assigned a unique id
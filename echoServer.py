@@ -1,15 +1,14 @@
 #! /usr/bin/env python3
-import re
-from select import select
-from socket import (AF_INET, SHUT_WR, SO_REUSEADDR, SOCK_STREAM, SOL_SOCKET,
-                    socket)
+import signal
 import sys
-import traceback
 
 import params
+from ringLog import levelsByName, log
 
 switchesVarDefaults = (
     (('-l', '--listenPort'), 'listenPort', 50001),
+    (('-w', '--workers'), 'workers', "1"),  # processes sharing listenPort
+    (('-L', '--logLevel'), 'logLevel', "info"),  # warning: no per-connection lines
     (('-d', '--debug'), 'debug', False),  # boolean (set if present)
     (('-?', '--usage'), 'usage', False),  # boolean (set if present)
     )
@@ -28,157 +27,35 @@ except:
     print(f"Can't parse listen port from {listenPort}")
     sys.exit(1)
 
-sockNames = {}            # from socket to name
-nextConnectionNumber = 0  # each connection is assigned a unique id
-
-
-class Fwd:
-    def __init__(self, conn, inSock, outSock, bufCap=1000):
-        self.inSock, self.outSock = inSock, outSock
-        self.conn, self.bufCap = conn, bufCap
-        self.inClosed, self.buf = 0, b""
-
-    def checkRead(self):
-        if len(self.buf) < self.bufCap and not self.inClosed:
-            return self.inSock
-        else:
-            return None
-
-    def checkWrite(self):
-        if len(self.buf) > 0:
-            return self.outSock
-        else:
-            return None
-
-    def doRecv(self):
-        b = b""
-        try:
-            b = self.inSock.recv(self.bufCap - len(self.buf))
-        except:
-            self.conn.die()
-        if len(b):
-            self.buf += b
-        else:
-            self.inClosed = 1
-        self.checkDone()
-
-    def doSend(self):
-        try:
-            n = self.outSock.send(self.buf)
-            self.buf = self.buf[n:]
-        except:
-            self.conn.die()
-        self.checkDone()
-
-    def checkDone(self):
-        if len(self.buf) == 0 and self.inClosed:
-            try:
-                self.outSock.shutdown(SHUT_WR)
-            except:
-                pass
-            self.conn.fwdDone(self)
-
-
-connections = set()
-
-
-class Conn:
-    def __init__(self, csock, caddr):
-        global nextConnectionNumber
-        self.csock = csock      # to client
-        self.caddr = caddr
-        self.connIndex = connIndex = nextConnectionNumber
-        nextConnectionNumber += 1
-        self.forwarders = forwarders = set()
-        sockName = sockNames[csock] = f"S.{connIndex}"
-        print(f"New connection {sockName} from {caddr}")
-        forwarders.add(Fwd(self, csock, csock))
-        connections.add(self)
-
-    def fwdDone(self, forwarder):
-        forwarders = self.forwarders
-        forwarders.remove(forwarder)
-        print(
-            f"Forwarder {sockNames[forwarder.inSock]} ==>",
-            f"{sockNames[forwarder.outSock]} from connection {self.connIndex}",
-            "shutting down",
-            )
-        if len(forwarders) == 0:
-            self.die()
-
-    def die(self):
-        print(f"Connection {self.connIndex} shutting down")
-        del sockNames[self.csock]
-        try:
-            self.csock.close()
-        except:
-            pass
-        connections.remove(self)
-
-    def doErr(self):
-        print(f"Forwarder from client {self.caddr} failing due to error")
-        self.die()
-
-
-class Listener:                 # a listener socket is a factory for established connections
-    def __init__(self, bindaddr, addrFamily=AF_INET, socktype=SOCK_STREAM):
-        self.bindaddr = bindaddr
-        self.addrFamily, self.socktype = addrFamily, socktype
-        self.lsock = lsock = socket(addrFamily, socktype)
-        sockNames[lsock] = "listener"
-        lsock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-        lsock.bind(bindaddr)
-        lsock.setblocking(False)
-        lsock.listen(2)
+try:
+    numWorkers = int(paramMap['workers'])
+    assert numWorkers > 0
+except:
+    print(f"Can't parse worker count from {paramMap['workers']}")
+    sys.exit(1)
 
-    def doRecv(self):
-        try:
-            csock, caddr = self.lsock.accept()  # socket connected to client
-            Conn(csock, caddr)
-        except:
-            print("Weird, listener readable but can't accept!")
-            traceback.print_exc(file=sys.stdout)
+if paramMap['logLevel'] not in levelsByName:
+    print(f"Unknown log level {paramMap['logLevel']}")
+    sys.exit(1)
+log.configure(level="debug" if debug else paramMap['logLevel'])
 
-    def doErr(self):
-        print("Listener socket failed!")
-        sys.exit(2)
+if numWorkers > 1:              # the supervisor stays in forkWorkers
+    import workers
+    workers.forkWorkers(numWorkers)
 
-    def checkRead(self):
-        return self.lsock
+import reactor                  # after forking: one selector per worker
 
-    def checkWrite(self):
-        return None
 
-    def checkErr(self):
-        return self.lsock
+class Conn(reactor.Conn):       # echo: one forwarder from the client to itself
+    __slots__ = ()
 
+    def __init__(self, csock, caddr, listener):
+        super().__init__(csock, caddr, listener)
+        log.conn("New connection #%d from %s", self.connIndex, caddr)
+        self.forward(csock, csock)
 
-l = Listener(("0.0.0.0", listenPort))
 
-while 1:
-    rmap, wmap, xmap = {}, {}, {}  # socket:object mappings for select
-    xmap[l.checkErr()] = l
-    rmap[l.checkRead()] = l
-    for conn in connections:
-        for sock in [conn.csock]:
-            xmap[sock] = conn
-            for fwd in conn.forwarders:
-                sock = fwd.checkRead()
-                if (sock):
-                    rmap[sock] = fwd
-                sock = fwd.checkWrite()
-                if (sock):
-                    wmap[sock] = fwd
-    rset, wset, xset = select(list(rmap.keys()), list(wmap.keys()),
-                              list(xmap.keys()), 60)
-    if debug:
-        print(
-            "ready sockets: ",
-            [[sockNames[s] for s in sset] for sset in [rset, wset, xset]]
-            )
-    for sock in rset:
-        rmap[sock].doRecv()
-    for sock in wset:
-        wmap[sock].doSend()
-    for sock in xset:
-        xmap[sock].doErr()
+reactor.Listener(("0.0.0.0", listenPort), Conn, reusePort=numWorkers > 1)
+# on SIGTERM run() returns, so buffered log records get flushed at exit
+reactor.onSignal(signal.SIGTERM, reactor.stop)
+reactor.run(60)
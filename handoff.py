@@ -0,0 +1,120 @@
+# Zero-downtime restart: hand the listening sockets to a new process.
+#
+# On SIGHUP the running server starts a copy of itself (same command line
+# plus --handoff FD) and sends it the descriptors of its listening sockets
+# over a Unix socketpair (SCM_RIGHTS).  The copy adopts them instead of
+# binding, so the ports never stop listening: clients that arrive while it
+# starts up wait in the shared backlog, or are still accepted by the old
+# process.  Once the copy reports that it is serving, the old process
+# closes its listeners and drains: it exits when its last connection has
+# finished, or when drainTimeout runs out.  If the copy dies before then,
+# the old process simply carries on.
+import socket
+import subprocess
+import sys
+import time
+
+from reactor import READ, connections, forget, setInterest, timerQueue
+from ringLog import log
+
+maxListeners = 16               # descriptors accepted in one handoff
+switches = ("-H", "--handoff")
+
+
+def restartCommand():
+    """This process's command line, minus any --handoff of its own"""
+    args, skip = [], False
+    for arg in sys.orig_argv[1:]:
+        if skip or arg in switches:
+            skip = not skip
+            continue
+        args.append(arg)
+    return [sys.executable] + args
+
+
+def inherit(fd):
+    """(channel, {name: listening socket}) from the process being replaced"""
+    channel = socket.socket(fileno=fd)
+    channel.setblocking(True)
+    msg, fds, flags, addr = socket.recv_fds(channel, 1024, maxListeners)
+    names = msg.decode().split()
+    if len(names) != len(fds):
+        raise RuntimeError(f"handoff sent {len(fds)} sockets for {names}")
+    return channel, {name: socket.socket(fileno=fd)
+                     for name, fd in zip(names, fds)}
+
+
+def ready(channel):
+    """Tell the old process we are serving, so it can stop accepting"""
+    channel.sendall(b"ready")
+    channel.close()
+
+
+class Handoff:
+    # listeners maps a name to an object with an lsock and a close()
+    def __init__(self, listeners, drainTimeout=60):
+        self.listeners, self.drainTimeout = listeners, drainTimeout
+        self.channel = self.proc = None
+        self.reply = b""
+        self.deadline = None    # time.monotonic() to give up draining
+
+    def start(self):            # from run(): see reactor.onSignal
+        if self.channel or self.deadline:
+            log.warning("Restart already in progress")
+            return
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        command = restartCommand() + [switches[1], str(theirs.fileno())]
+        try:
+            self.proc = subprocess.Popen(command, pass_fds=[theirs.fileno()])
+            names = list(self.listeners)
+            socket.send_fds(ours, [" ".join(names).encode()],
+                            [self.listeners[n].lsock.fileno() for n in names])
+        except OSError as e:
+            log.error("Can't start replacement process: %r", e)
+            ours.close()
+            return
+        finally:
+            theirs.close()
+        log.info("Handing listeners to new process %d", self.proc.pid)
+        self.channel = ours
+        ours.setblocking(False)
+        setInterest(ours, READ, self)
+
+    def doRecv(self):
+        try:
+            b = self.channel.recv(64)
+        except BlockingIOError:
+            return
+        except OSError:
+            b = b""
+        self.reply += b
+        if self.reply == b"ready":
+            self.closeChannel()
+            self.drain()
+        elif not b:
+            self.closeChannel()
+            log.error("Replacement process %d failed (status %s),"
+                      " still serving", self.proc.pid, self.proc.poll())
+
+    def closeChannel(self):
+        forget(self.channel)
+        self.channel.close()
+        self.channel, self.reply = None, b""
+
+    def drain(self):
+        for listener in self.listeners.values():
+            listener.close()
+        self.deadline = time.monotonic() + self.drainTimeout
+        log.info("New process %d is serving; draining %d connections",
+                 self.proc.pid, len(connections))
+        self.checkDrained()
+
+    def checkDrained(self):
+        if connections and time.monotonic() < self.deadline:
+            timerQueue.schedule(0.1, self.checkDrained)
+            return
+        if connections:
+            log.warning("Drain timeout: closing %d connections",
+                        len(connections))
+        log.info("Drained, exiting")
+        sys.exit(0)
@@ -0,0 +1,79 @@
+#! /usr/bin/env python3
+# Memory cost of idle connections through the proxy.
+#
+# Starts echoServer.py and proxy.py (with its metrics endpoint), notes the
+# proxy's RSS, opens --conns client connections that never send anything,
+# waits until the proxy reports them all open, and prints the RSS growth
+# per connection.  Each idle proxied connection holds two sockets, so the
+# file-descriptor limit is raised to its hard limit first (the servers
+# inherit it).
+import resource
+import socket
+import sys
+import time
+from urllib.request import urlopen
+
+from benchProcs import raiseFdLimit, rss, start, stop
+import params
+
+switchesVarDefaults = (
+    (('-n', '--conns'), 'conns', "10000"),
+    (('-p', '--basePort'), 'basePort', "52000"),
+    (('-a', '--proxyArgs'), 'proxyArgs', "none"),  # e.g. "-S" or "-C latency"
+    (('-?', '--usage'), 'usage', False),  # boolean (set if present)
+    )
+
+paramMap = params.parseParams(switchesVarDefaults)
+if paramMap['usage']:
+    params.usage()
+
+try:
+    conns = int(paramMap['conns'])
+    basePort = int(paramMap['basePort'])
+    proxyArgs = [] if paramMap['proxyArgs'] == "none" else paramMap['proxyArgs'].split()
+except:
+    print("Can't parse benchmark parameters")
+    sys.exit(1)
+
+hard = raiseFdLimit()
+if hard != resource.RLIM_INFINITY and hard < 2 * conns + 100:
+    print(f"File descriptor limit {hard} is too low for {conns} connections")
+    sys.exit(1)
+
+echoPort, proxyPort, metricsPort = basePort, basePort + 1, basePort + 2
+
+
+def activeConnections():
+    with urlopen(f"http://127.0.0.1:{metricsPort}/metrics") as response:
+        for line in response.read().decode().splitlines():
+            if line.startswith("proxy_active_connections "):
+                return int(float(line.split()[1]))
+    return 0
+
+
+echo = start("echoServer.py", ["-l", str(echoPort), "-L", "warning"], echoPort)
+try:
+    proxy = start("proxy.py", ["-l", str(proxyPort), "-s", f"127.0.0.1:{echoPort}",
+                               "-m", str(metricsPort), "-L", "warning"] + proxyArgs,
+                  proxyPort)
+    try:
+        while activeConnections():      # let the port probe's Conn go away
+            time.sleep(0.05)
+        before = rss(proxy.pid)
+        clients = []
+        for i in range(conns):
+            clients.append(socket.create_connection(("127.0.0.1", proxyPort)))
+        deadline = time.monotonic() + 60
+        while activeConnections() < conns:
+            if time.monotonic() > deadline:
+                raise RuntimeError("proxy never reported every connection open")
+            time.sleep(0.1)
+        after = rss(proxy.pid)
+        print(f"{conns} idle connections: proxy RSS {before >> 20} -> "
+              f"{after >> 20} MiB, {(after - before) / conns:.0f} bytes each")
+        for c in clients:
+            c.close()
+    finally:
+        stop(proxy)
+finally:
+    stop(echo)
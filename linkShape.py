@@ -0,0 +1,250 @@
+# Link profiles that let stammerProxy.py emulate slow or distant networks.
+#
+# A LinkShaper is the reactor filter that applies a profile to one direction
+# of a connection.
+#
+# A profile is a preset name and/or comma-separated key=value settings, e.g.
+# "3g", "dsl,delay=40ms" or "rate=10M,burst=32k,frag=1-1460":
+#   rate    bandwidth cap in bits/s (k, M, G suffixes); 0 = unlimited
+#   burst   token-bucket depth in bytes (k, M suffixes); default rate/50
+#   delay   fixed one-way delay (s, ms or us suffix; bare numbers are s)
+#   jitter  each chunk's delay varies uniformly by +-jitter (never reorders)
+#   frag    fragment sizes: "all" (send what's buffered), "any" (uniform from
+#           1 to what's buffered), "N", "MIN-MAX" or "A/B/..." (equally likely)
+#   gap     pause after each fragment
+#   buf     bytes buffered per direction before reading stops; by default
+#           64k, or enough to keep a rate-limited, delayed link full
+#           (rate * (delay + jitter) + burst) if that is more
+# Each forwarder gets its own random.Random, seeded from --seed plus the
+# connection and direction, so a seeded run is reproducible.
+from collections import deque
+import random
+import re
+
+from reactor import Filter, timerQueue
+from ringLog import log
+import timers
+
+presets = {
+    "stammer": "frag=any,gap=100ms,buf=1000",   # the original behavior
+    "none": "",
+    "lan": "rate=1G,delay=100us",
+    "dsl": "rate=8M,delay=20ms,jitter=5ms",
+    "cable": "rate=50M,delay=10ms,jitter=2ms",
+    "3g": "rate=2M,delay=100ms,jitter=30ms,frag=1-1400",
+    "satellite": "rate=20M,delay=300ms,jitter=10ms",
+    }
+
+sizeUnits = {"": 1, "k": 1 << 10, "m": 1 << 20}
+rateUnits = {"": 1, "k": 1e3, "m": 1e6, "g": 1e9}
+timeUnits = {"": 1, "s": 1, "ms": 1e-3, "us": 1e-6}
+
+
+def parseUnit(text, units, what):
+    m = re.fullmatch(r"([\d.]+)([a-z]*)", text.strip().lower())
+    if not m or m.group(2) not in units:
+        raise ValueError(f"bad {what} {text!r}")
+    return float(m.group(1)) * units[m.group(2)]
+
+
+def parseSize(text):
+    return int(parseUnit(text, sizeUnits, "size"))
+
+
+class LinkProfile:
+    def __init__(self, spec="none"):
+        self.spec = spec
+        self.rate = 0.0         # bytes/s; 0 = unlimited
+        self.burst = None
+        self.delay = self.jitter = self.gap = 0.0
+        self.fragLo = self.fragHi = None   # None: bounded only by the buffer
+        self.fragChoices = None
+        self.fragAny = False
+        self.bufCap = None
+        items = [i for i in spec.split(",") if i.strip()]
+        if items and "=" not in items[0]:
+            name = items.pop(0).strip()
+            if name not in presets:
+                raise ValueError(f"unknown link profile {name!r}")
+            items = [i for i in presets[name].split(",") if i] + items
+        for item in items:
+            key, sep, value = item.partition("=")
+            key = key.strip()
+            if not sep:
+                raise ValueError(f"expected key=value, not {item!r}")
+            if key == "rate":
+                self.rate = parseUnit(value, rateUnits, "rate") / 8
+            elif key == "burst":
+                self.burst = parseSize(value)
+            elif key in ("delay", "jitter", "gap"):
+                setattr(self, key, parseUnit(value, timeUnits, key))
+            elif key == "frag":
+                self.parseFrag(value.strip())
+            elif key == "buf":
+                self.bufCap = parseSize(value)
+            else:
+                raise ValueError(f"unknown link setting {key!r}")
+        if self.burst is None:
+            self.burst = max(int(self.rate / 50), 1500)
+        if self.rate and self.fragHi:
+            self.burst = max(self.burst, self.fragHi)
+        if self.bufCap is None:     # room for what is "on the wire"
+            inFlight = self.rate * (self.delay + self.jitter) + self.burst
+            self.bufCap = max(65536, int(inFlight))
+        if self.bufCap < 1 or (self.rate and self.burst < 1):
+            raise ValueError(f"bad link profile {spec!r}")
+
+    def parseFrag(self, value):
+        self.fragLo = self.fragHi = self.fragChoices = None
+        self.fragAny = value == "any"
+        if value in ("all", "any"):
+            return
+        if "-" in value:
+            lo, hi = value.split("-")
+            self.fragLo, self.fragHi = parseSize(lo), parseSize(hi)
+        else:
+            self.fragChoices = [parseSize(v) for v in value.split("/")]
+            self.fragLo, self.fragHi = min(self.fragChoices), max(self.fragChoices)
+        if self.fragLo < 1 or self.fragHi < self.fragLo:
+            raise ValueError(f"bad fragment sizes {value!r}")
+
+    @property
+    def shaped(self):           # does this profile do anything at all?
+        return bool(self.rate or self.delay or self.jitter or self.gap or
+                    self.fragAny or self.fragHi)
+
+    def chunkDelay(self, rng):
+        if not self.jitter:
+            return self.delay
+        return max(self.delay + rng.uniform(-self.jitter, self.jitter), 0)
+
+    def fragSize(self, rng, available):
+        """Size of the next fragment to send, given available bytes"""
+        if self.fragAny:
+            n = rng.randint(1, available)
+        elif self.fragChoices:
+            n = rng.choice(self.fragChoices)
+        elif self.fragHi:
+            n = rng.randint(self.fragLo, self.fragHi)
+        else:
+            n = available
+        if self.rate:
+            n = min(n, self.burst)
+        return n
+
+    def __str__(self):
+        return self.spec
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst, now):
+        self.rate, self.burst = rate, burst
+        self.tokens, self.stamp = burst, now
+
+    def waitFor(self, n, now):
+        """Seconds until n bytes may be sent (0 if they may be sent now)"""
+        tokens = min(self.tokens + (now - self.stamp) * self.rate, self.burst)
+        self.tokens, self.stamp = tokens, now
+        return 0 if tokens >= n else (n - tokens) / self.rate
+
+    def take(self, n):
+        self.tokens -= n
+
+
+def rngFor(seed, connIndex, direction):
+    """Independent, reproducible (if seed is not None) stream per forwarder"""
+    if seed is None:
+        return random.Random()
+    return random.Random(f"{seed}/{connIndex}/{direction}")
+
+
+class LinkShaper(Filter):
+    # Chunks wait in pending until their one-way delay is over, then in
+    # ready, from which one fragment at a time is emitted once the output
+    # buffer has drained and the token bucket and gap allow.  Each shaper
+    # holds at most one live timer, for whichever of those comes first.
+    # It paces the forwarder's output, so it should be the last filter.
+    def __init__(self, profile, rng):
+        self.profile, self.rng = profile, rng
+        self.pending = deque()   # (releaseAt, bytes) still "on the wire"
+        self.pendingBytes = 0
+        self.lastRelease = 0     # jitter must not reorder the stream
+        self.ready = bytearray()
+        self.bucket = (TokenBucket(profile.rate, profile.burst, timers.now)
+                       if profile.rate else None)
+        self.nextFrag = 0        # size of the fragment being sent; 0 = pick
+        self.sendAfter = 0       # no delay
+        self.finishing = False
+        self.timer = None        # next wake(), if any
+
+    def push(self, data):
+        profile = self.profile
+        if profile.delay or profile.jitter:
+            releaseAt = max(timers.now + profile.chunkDelay(self.rng),
+                            self.lastRelease)
+            self.lastRelease = releaseAt
+            self.pending.append((releaseAt, data))
+            self.pendingBytes += len(data)
+        else:
+            self.ready += data
+        self.pump()
+
+    def finish(self):
+        self.finishing = True
+        self.pump()
+
+    def held(self):
+        return self.pendingBytes + len(self.ready)
+
+    def drained(self):
+        self.pump()
+
+    def close(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    def armAt(self, when):
+        timer = self.timer
+        if timer and not timer.cancelled:
+            if timer.when <= when:
+                return          # wake() will re-arm for the rest
+            timer.cancel()
+        self.timer = timerQueue.scheduleAt(when, self.wake)
+
+    def wake(self):
+        self.timer = None
+        self.pump()
+
+    def pump(self):
+        pending, ready, now = self.pending, self.ready, timers.now
+        while pending and pending[0][0] <= now:     # delay is over
+            releaseAt, b = pending.popleft()
+            self.pendingBytes -= len(b)
+            ready += b
+        if ready and not self.fwd.out and now >= self.sendAfter:
+            if not self.nextFrag:
+                self.nextFrag = self.profile.fragSize(self.rng, len(ready))
+            n = min(self.nextFrag, len(ready))
+            wait = self.bucket.waitFor(n, now) if self.bucket else 0
+            if wait:            # out of tokens: sleep until there are enough
+                self.sendAfter = now + wait
+            else:
+                log.debug("Emitting %d of %d", n, len(ready))
+                self.nextFrag = 0
+                if self.bucket:
+                    self.bucket.take(n)
+                fragment = bytes(ready[:n])
+                del ready[:n]
+                if ready and self.profile.gap:
+                    self.sendAfter = now + self.profile.gap
+                self.emit(fragment)
+        if pending:
+            self.armAt(pending[0][0])
+        if ready and now < self.sendAfter:
+            self.armAt(self.sendAfter)
+        elif self.finishing and not ready and not pending:
+            self.finishing = False
+            self.next.finish()
@@ -0,0 +1,109 @@
+# On-demand diagnostics for a live event loop.
+#
+# A LoopProfile, given to reactor.configure(loopProfile=...), makes run()
+# time each phase of every iteration (working out the select timeout,
+# select() itself, running due timers, and the whole busy part) and every
+# doRecv/doSend call, per handler class, into histograms.  A histogram is a
+# list of counts indexed by the bit length of the duration in nanoseconds,
+# so recording costs an increment; report() turns them into a table.
+#
+# A ProfileWindow switches cProfile on and off on request (from a signal,
+# through reactor.onSignal), for at most window seconds at a time, and
+# writes each window's statistics to a .prof file (for pstats or snakeviz)
+# plus a summary in the log.
+import cProfile
+import io
+import os
+import pstats
+
+from reactor import READ, timerQueue
+from ringLog import log
+
+
+class Histogram:
+    __slots__ = ("counts", "total")
+
+    def __init__(self):
+        self.counts = [0] * 64  # counts[i]: durations below 2**i ns
+        self.total = 0          # ns
+
+    def add(self, ns):
+        self.counts[ns.bit_length()] += 1
+        self.total += ns
+
+    def quantile(self, q):      # upper bound of the bucket holding quantile q
+        rank, seen = q * sum(self.counts), 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return 1 << i
+        return 0
+
+
+class LoopProfile:
+    phaseNames = ("timeout", "select", "timers", "busy")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.phases = {name: Histogram() for name in self.phaseNames}
+        self.handlers = {}      # (handler class, READ or WRITE): Histogram
+
+    def handler(self, handlerClass, which):
+        hist = self.handlers.get((handlerClass, which))
+        if hist is None:
+            hist = self.handlers[handlerClass, which] = Histogram()
+        return hist
+
+    def report(self):
+        lines = [f"{'phase/handler':<24} {'count':>10} {'mean us':>9}"
+                 f" {'p50 us':>9} {'p99 us':>9} {'max us':>9}"]
+        rows = list(self.phases.items()) + sorted(
+            (f"{cls.__name__}.{'doRecv' if which == READ else 'doSend'}", h)
+            for (cls, which), h in self.handlers.items())
+        for name, h in rows:
+            n = sum(h.counts)
+            if not n:
+                continue
+            lines.append(f"{name:<24} {n:>10} {h.total / n / 1e3:>9.1f}"
+                         f" {h.quantile(0.5) / 1e3:>9.1f}"
+                         f" {h.quantile(0.99) / 1e3:>9.1f}"
+                         f" {h.quantile(1) / 1e3:>9.1f}")
+        return "\n".join(lines)
+
+    def dump(self):             # from run(): see reactor.onSignal
+        log.warning("Event loop profile since the last dump (bucket upper"
+                    " bounds):\n%s", self.report())
+        self.reset()
+
+
+class ProfileWindow:
+    def __init__(self, window=30, prefix="proxy"):
+        self.window, self.prefix = window, prefix
+        self.profiler = self.timer = None
+        self.windows = 0
+
+    def toggle(self):           # from run(): see reactor.onSignal
+        if self.profiler:
+            self.stop()
+        else:
+            self.start()
+
+    def start(self):
+        self.profiler = cProfile.Profile()
+        self.timer = timerQueue.schedule(self.window, self.stop)
+        log.warning("Profiling for at most %ss", self.window)
+        self.profiler.enable()
+
+    def stop(self):
+        profiler, self.profiler = self.profiler, None
+        profiler.disable()
+        self.timer.cancel()
+        self.windows += 1
+        path = f"{self.prefix}.{os.getpid()}.{self.windows}.prof"
+        profiler.dump_stats(path)
+        text = io.StringIO()
+        pstats.Stats(profiler, stream=text).sort_stats("tottime").print_stats(15)
+        log.warning("Profile written to %s:\n%s", path,
+                    text.getvalue().strip("\n"))
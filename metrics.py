@@ -0,0 +1,80 @@
+# Counters and gauges for proxy.py, rendered in Prometheus text format.
+#
+# The hot path only bumps integers in a Metrics object; anything that would
+# cost a scan of all connections (active connections, buffer occupancy) is
+# computed by a callback when the endpoint is scraped.
+from bisect import bisect_left
+import time
+
+C2S, S2C = 0, 1                 # forwarding directions
+directionNames = ("client_to_server", "server_to_client")
+
+# upper bounds (seconds) of the event-loop iteration time histogram buckets
+loopBuckets = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+               0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+class Metrics:
+    def __init__(self):
+        self.acceptsTotal = 0
+        self.closedTotal = 0
+        self.refusedTotal = 0   # accepted only to be reset (over a limit)
+        self.bufferResizes = 0  # forwarder buffers grown or shrunk
+        self.bytesIn = [0, 0]   # read from the input socket, per direction
+        self.bytesOut = [0, 0]  # written to the output socket, per direction
+        self.loopCounts = [0] * (len(loopBuckets) + 1)
+        self.loopSum = 0.0
+        self.startTime = time.time()
+
+    def observeLoop(self, seconds):     # time spent handling one wakeup
+        self.loopCounts[bisect_left(loopBuckets, seconds)] += 1
+        self.loopSum += seconds
+
+    def render(self, gauges=()):
+        """Prometheus text exposition of the counters plus extra gauges.
+
+        gauges is a sequence of (name, help, [(labels, value), ...])."""
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                if labels:
+                    labelText = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                    lines.append(f"{name}{{{labelText}}} {value}")
+                else:
+                    lines.append(f"{name} {value}")
+
+        metric("proxy_start_time_seconds", "gauge",
+               "Unix time the proxy started", [({}, self.startTime)])
+        metric("proxy_accepts_total", "counter",
+               "Client connections accepted", [({}, self.acceptsTotal)])
+        metric("proxy_accepts_refused_total", "counter",
+               "Client connections reset because of an admission limit",
+               [({}, self.refusedTotal)])
+        metric("proxy_connections_closed_total", "counter",
+               "Client connections closed", [({}, self.closedTotal)])
+        metric("proxy_buffer_resizes_total", "counter",
+               "Forwarder buffers grown or shrunk", [({}, self.bufferResizes)])
+        metric("proxy_received_bytes_total", "counter",
+               "Bytes read from the input side of each direction",
+               [({"direction": d}, n)
+                for d, n in zip(directionNames, self.bytesIn)])
+        metric("proxy_sent_bytes_total", "counter",
+               "Bytes written to the output side of each direction",
+               [({"direction": d}, n)
+                for d, n in zip(directionNames, self.bytesOut)])
+        for name, help, samples in gauges:
+            metric(name, "gauge", help, samples)
+        name = "proxy_loop_iteration_seconds"
+        lines.append(f"# HELP {name} Time spent handling the events of one"
+                     " event-loop wakeup")
+        lines.append(f"# TYPE {name} histogram")
+        cumulative = 0
+        for le, count in zip(loopBuckets + ("+Inf",), self.loopCounts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{le}"}} {cumulative}')
+        lines.append(f"{name}_sum {self.loopSum}")
+        lines.append(f"{name}_count {cumulative}")
+        return "\n".join(lines) + "\n"
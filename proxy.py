@@ -1,16 +1,50 @@
 #! /usr/bin/env python3
-import re
-from select import select
-from socket import (AF_INET, SHUT_WR, SO_REUSEADDR, SOCK_STREAM, SOL_SOCKET,
-                    socket)
+import atexit
+from collections import deque
+import os
+import signal
+from socket import (AF_INET, MSG_PEEK, SO_ERROR, SO_REUSEADDR, SOCK_STREAM,
+                    SOL_SOCKET, socket)
 import sys
-import traceback
+import time
 
+import backends
+from capture import CaptureFile
+from metrics import C2S, S2C, directionNames
 import params
+from resolver import Resolver
+from ringLog import levelsByName, log
+from sockOpts import SockOpts
 
 switchesVarDefaults = (
     (('-l', '--listenPort'), 'listenPort', 50000),
-    (('-s', '--server'), 'server', "127.0.0.1:50001"),
+    (('-s', '--server'), 'server', "127.0.0.1:50001"),  # host:port[@weight],...
+    (('-B', '--balance'), 'balance', "rr"),  # rr, leastconn or hash
+    (('-b', '--bufCap'), 'bufCap', 262144),  # max bytes buffered per direction
+    (('-n', '--bufMin'), 'bufMin', "4096"),  # initial/idle buffer size
+    (('-f', '--flushBytes'), 'flushBytes', "0"),  # coalesce smaller writes
+    (('-F', '--flushDelay'), 'flushDelay', "0.001"),  # seconds writes wait
+    (('-S', '--splice'), 'splice', False),  # forward in-kernel (Linux)
+    (('-e', '--engine'), 'engine', "select"),  # select or asyncio
+    (('-w', '--workers'), 'workers', "1"),  # processes sharing listenPort
+    (('-p', '--pool'), 'pool', "0"),  # pre-connected server sockets to keep
+    (('-m', '--metricsPort'), 'metricsPort', "0"),  # Prometheus text; 0=off
+    (('-c', '--connectTimeout'), 'connectTimeout', "10"),  # seconds; 0=none
+    (('-i', '--idleTimeout'), 'idleTimeout', "0"),  # seconds; 0=none
+    (('-t', '--dnsTtl'), 'dnsTtl', "30"),  # seconds between backend lookups
+    (('-C', '--clientOpts'), 'clientOpts', "default"),  # latency/throughput
+    (('-O', '--serverOpts'), 'serverOpts', "default"),  # latency/throughput
+    (('-k', '--backlog'), 'backlog', "1024"),  # listen() queue length
+    (('-x', '--maxConns'), 'maxConns', "0"),  # concurrent clients; 0=unlimited
+    (('-r', '--acceptRate'), 'acceptRate', "0"),  # new clients/s; 0=unlimited
+    (('-o', '--overload'), 'overload', "queue"),  # over a limit: queue or refuse
+    (('-D', '--drainTimeout'), 'drainTimeout', "60"),  # seconds, after SIGHUP
+    (('-H', '--handoff'), 'handoff', "none"),  # internal: set on SIGHUP restart
+    (('-K', '--capture'), 'capture', "none"),  # record to CAPTURE.<pid>
+    (('-Z', '--captureMB'), 'captureMB', "1024"),  # size limit per file
+    (('-T', '--loopStats'), 'loopStats', False),  # time loop phases; SIGUSR1 dumps
+    (('-P', '--profileWindow'), 'profileWindow', "30"),  # SIGUSR2 cProfile limit (s)
+    (('-L', '--logLevel'), 'logLevel', "info"),  # debug/info/warning/error
     (('-d', '--debug'), 'debug', False),  # boolean (set if present)
     (('-?', '--usage'), 'usage', False),  # boolean (set if present)
     )
@@ -20,184 +54,500 @@ server = paramMap['server']
 listenPort = paramMap['listenPort']
 usage = paramMap['usage']
 debug = paramMap['debug']
+splice = paramMap['splice']
+engine = paramMap['engine']
 
 if usage:
     params.usage()
 
 try:
-    serverHost, serverPort = re.split(":", server)
-    serverPort = int(serverPort)
+    serverList = backends.parseBackends(server)
 except:
     print(f"Can't parse server:port from {server}")
     sys.exit(1)
 
+if paramMap['balance'] not in backends.strategies:
+    print(f"Unknown balancing strategy {paramMap['balance']}")
+    sys.exit(1)
+
 try:
     listenPort = int(listenPort)
 except:
     print(f"Can't parse listen port from {listenPort}")
     sys.exit(1)
 
-sockNames = {}               # from socket to name
-nextConnectionNumber = 0     # each connection is assigned a unique id
+try:
+    bufCap = int(paramMap['bufCap'])
+    bufMin = min(int(paramMap['bufMin']), bufCap)
+    assert bufMin > 0
+except:
+    print(f"Can't parse buffer sizes from {paramMap['bufCap']}, {paramMap['bufMin']}")
+    sys.exit(1)
 
+try:
+    flushBytes = int(paramMap['flushBytes'])
+    flushDelay = float(paramMap['flushDelay'])
+    assert flushBytes >= 0 and flushDelay > 0
+except:
+    print(f"Can't parse write coalescing from {paramMap['flushBytes']}, {paramMap['flushDelay']}")
+    sys.exit(1)
+if engine == "asyncio" and flushBytes:
+    print("--flushBytes is only supported by the select engine")
+    sys.exit(1)
+if splice and flushBytes:
+    print("--flushBytes doesn't apply to --splice (data never reaches the proxy)")
+    sys.exit(1)
 
-class Fwd:
-    def __init__(self, conn, inSock, outSock, bufCap=1000):
-        self.inSock, self.outSock = inSock, outSock
-        self.conn, self.bufCap = conn, bufCap
-        self.inClosed, self.buf = 0, b""
+if splice and not hasattr(os, "splice"):
+    print("--splice needs os.splice (Linux, Python 3.10 or newer)")
+    sys.exit(1)
 
-    def checkRead(self):
-        if len(self.buf) < self.bufCap and not self.inClosed:
-            return self.inSock
-        else:
-            return None
+if engine not in ("select", "asyncio"):
+    print(f"Unknown engine {engine}")
+    sys.exit(1)
+if engine == "asyncio" and splice:
+    print("--splice is only supported by the select engine")
+    sys.exit(1)
 
-    def checkWrite(self):
-        if len(self.buf) > 0:
-            return self.outSock
-        else:
-            return None
+try:
+    numWorkers = int(paramMap['workers'])
+    assert numWorkers > 0
+except:
+    print(f"Can't parse worker count from {paramMap['workers']}")
+    sys.exit(1)
 
-    def doRecv(self):
-        b = b""
-        try:
-            b = self.inSock.recv(self.bufCap - len(self.buf))
-        except:
-            self.conn.die()
-        if len(b):              # read something
-            self.buf += b
-        else:                   # zero length read (input closed)
-            self.inClosed = 1
-        self.checkDone()
+try:
+    poolSize = int(paramMap['pool'])
+    assert poolSize >= 0
+except:
+    print(f"Can't parse pool size from {paramMap['pool']}")
+    sys.exit(1)
+if engine == "asyncio" and poolSize:
+    print("--pool is only supported by the select engine")
+    sys.exit(1)
 
-    def doSend(self):
+try:
+    metricsPort = int(paramMap['metricsPort'])
+except:
+    print(f"Can't parse metrics port from {paramMap['metricsPort']}")
+    sys.exit(1)
+if engine == "asyncio" and metricsPort:
+    print("--metricsPort is only supported by the select engine")
+    sys.exit(1)
+if metricsPort and numWorkers > 1:   # each worker would bind the port
+    print("--metricsPort needs a single worker")
+    sys.exit(1)
+
+try:
+    connectTimeout = float(paramMap['connectTimeout'])
+    idleTimeout = float(paramMap['idleTimeout'])
+    assert connectTimeout >= 0 and idleTimeout >= 0
+except:
+    print("Can't parse connect/idle timeouts")
+    sys.exit(1)
+
+try:
+    backlog = int(paramMap['backlog'])
+    maxConns = int(paramMap['maxConns'])
+    acceptRate = float(paramMap['acceptRate'])
+    assert backlog > 0 and maxConns >= 0 and acceptRate >= 0
+except:
+    print("Can't parse backlog/maxConns/acceptRate")
+    sys.exit(1)
+if paramMap['overload'] not in ("queue", "refuse"):
+    print(f"Unknown overload policy {paramMap['overload']}")
+    sys.exit(1)
+if engine == "asyncio" and (maxConns or acceptRate):
+    print("--maxConns and --acceptRate are only supported by the select engine")
+    sys.exit(1)
+
+try:
+    drainTimeout = float(paramMap['drainTimeout'])
+    handoffFd = None if paramMap['handoff'] == "none" else int(paramMap['handoff'])
+except:
+    print("Can't parse drain timeout/handoff descriptor")
+    sys.exit(1)
+# SIGHUP restarts hand over this process's listeners; a supervisor has none
+hotRestart = engine == "select" and numWorkers == 1
+if handoffFd is not None and not hotRestart:
+    print("--handoff needs the select engine and a single worker")
+    sys.exit(1)
+
+try:
+    captureMB = int(paramMap['captureMB'])
+    assert captureMB > 0
+except:
+    print(f"Can't parse capture size from {paramMap['captureMB']}")
+    sys.exit(1)
+capturing = paramMap['capture'] != "none"
+if capturing and (splice or engine == "asyncio"):
+    print("--capture needs the select engine without --splice")
+    sys.exit(1)
+
+try:
+    profileWindow = float(paramMap['profileWindow'])
+    assert profileWindow > 0
+except:
+    print(f"Can't parse profile window from {paramMap['profileWindow']}")
+    sys.exit(1)
+if engine == "asyncio" and paramMap['loopStats']:
+    print("--loopStats is only supported by the select engine")
+    sys.exit(1)
+
+try:
+    dnsTtl = float(paramMap['dnsTtl'])
+except:
+    print(f"Can't parse DNS TTL from {paramMap['dnsTtl']}")
+    sys.exit(1)
+
+try:
+    clientOpts = SockOpts(paramMap['clientOpts'])
+    serverOpts = SockOpts(paramMap['serverOpts'])
+except ValueError as e:
+    print(f"Can't parse socket options: {e}")
+    sys.exit(1)
+if engine == "asyncio" and (clientOpts.options or serverOpts.options):
+    print("--clientOpts and --serverOpts are only supported by the select engine")
+    sys.exit(1)
+
+if paramMap['logLevel'] not in levelsByName:
+    print(f"Unknown log level {paramMap['logLevel']}")
+    sys.exit(1)
+log.configure(level="debug" if debug else paramMap['logLevel'])
+
+if numWorkers > 1:              # the supervisor stays in forkWorkers
+    import workers
+    workers.forkWorkers(numWorkers)
+
+# exit through sys.exit on SIGTERM so buffered log records get flushed (the
+# select engine replaces this below: run() returns instead)
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+# after forking: every worker needs its own selector
+import reactor
+from reactor import (READ, WRITE, Fwd, Listener, SpliceFwd, connections,
+                     forget, setInterest, stats, timerQueue)
+import handoff
+from loopProfile import LoopProfile, ProfileWindow
+
+captureFile = None              # one per process: workers never share a file
+if capturing:
+    captureFile = CaptureFile(f"{paramMap['capture']}.{os.getpid()}",
+                              captureMB << 20)
+    atexit.register(captureFile.close)
+
+loopProfile = LoopProfile() if paramMap['loopStats'] else None
+
+reactor.configure(bufCap=bufCap, bufMin=bufMin, connectTimeout=connectTimeout,
+                  idleTimeout=idleTimeout, backlog=backlog, maxConns=maxConns,
+                  acceptRate=acceptRate, overload=paramMap['overload'],
+                  flushBytes=flushBytes, flushDelay=flushDelay,
+                  capture=captureFile, loopProfile=loopProfile)
+
+
+resolver = Resolver(dnsTtl)     # after forking: the thread is per worker
+for backend in serverList:
+    resolver.add(backend)
+resolver.start()
+
+
+class UpstreamPool:
+    """Warm set of non-blocking sockets already connected to a backend.
+
+    fill() tops the pool up to minSize from inside the event loop; failed
+    connects eject the backend, so a dead server isn't hammered.  Sockets
+    the server closes while idle are replaced after a back-off that doubles
+    until a pooled socket is used, so a server that drops idle connections
+    isn't reconnected to in a loop either."""
+    minRefill, maxRefill = 0.1, 10.0    # seconds, after an idle close
+
+    def __init__(self, backend, socktype, minSize, opts):
+        self.backend, self.socktype = backend, socktype
+        self.opts = opts        # socket options for the server side
+        self.saddr = backend.saddr
+        self.minSize = minSize
+        self.connecting, self.ready = set(), deque()
+        self.retryTimer = None
+        self.refillDelay = self.minRefill
+
+    def fill(self):
+        backend = self.backend
+        addr = backend.address()
+        if addr is None and backend.available(time.monotonic()):
+            backend.failed()    # unresolved: retry as if it were down
+        if not backend.available(time.monotonic()):
+            if self.retryTimer is None:     # try again when it's back
+                self.retryTimer = timerQueue.scheduleAt(
+                    backend.ejectedUntil, self.retry)
+            return
+        family, sockaddr = addr
+        while len(self.connecting) + len(self.ready) < self.minSize:
+            sock = socket(family, self.socktype)
+            sock.setblocking(False)
+            self.opts.apply(sock)
+            sock.connect_ex(sockaddr)
+            self.connecting.add(sock)
+            setInterest(sock, WRITE, PooledSock(self, sock))
+
+    def retry(self):
+        self.retryTimer = None
+        self.fill()
+
+    def take(self):             # a connected socket, or None if none is ready
+        sock = None
+        if self.ready:
+            sock = self.ready.popleft()
+            forget(sock)
+            self.refillDelay = self.minRefill
+        self.fill()
+        return sock
+
+    def connected(self, sock):
+        self.connecting.discard(sock)
+        self.ready.append(sock)
+        self.backend.succeeded()
+        setInterest(sock, WRITE, None)  # now only watch for the server leaving
+
+    def discard(self, sock, failed):
+        self.connecting.discard(sock)
         try:
-            n = self.outSock.send(self.buf)
-            self.buf = self.buf[n:]
-        except:
-            self.conn.die()
-        self.checkDone()
-
-    def checkDone(self):
-        if len(self.buf) == 0 and self.inClosed:
-            self.outSock.shutdown(SHUT_WR)
-            self.conn.fwdDone(self)
-
-
-connections = set()
-
-
-class Conn:
-    def __init__(self, csock, caddr, af, socktype, saddr):
-        global nextConnectionNumber
-        self.csock = csock  # to client
-        self.caddr, self.saddr = caddr, saddr  # addresses
-        self.connIndex = connIndex = nextConnectionNumber
-        nextConnectionNumber += 1
-        self.ssock = ssock = socket(af, socktype) # socket to connect to server
-        self.forwarders = forwarders = set()
-        print(f"New connection #{connIndex} from {caddr}")
-        sockNames[csock] = f"ToClnt.{connIndex}"
-        sockNames[ssock] = f"ToSrvr.{connIndex}"
-        ssock.setblocking(False)
-        ssock.connect_ex(saddr)  # start connecting
-        forwarders.add(Fwd(self, csock, ssock))
-        forwarders.add(Fwd(self, ssock, csock))
-        connections.add(self)
-
-    def fwdDone(self, forwarder):
-        forwarders = self.forwarders
-        forwarders.remove(forwarder)
-        print(
-            f"Forwarder {sockNames[forwarder.inSock]} ==>",
-            f"{sockNames[forwarder.outSock]} from connection {self.connIndex}",
-            "shutting down",
-            )
-        if len(forwarders) == 0:
+            self.ready.remove(sock)
+        except ValueError:
+            pass
+        forget(sock)
+        sock.close()
+        if failed:
+            if self.backend.available(time.monotonic()):
+                self.backend.failed()
+            self.fill()
+        elif self.retryTimer is None:       # closed while idle: back off
+            self.retryTimer = timerQueue.schedule(self.refillDelay, self.retry)
+            self.refillDelay = min(self.refillDelay * 2, self.maxRefill)
+
+
+class PooledSock:               # selector handler for a socket in the pool
+    def __init__(self, pool, sock):
+        self.pool, self.sock = pool, sock
+        self.connectTimer = None
+        if connectTimeout:
+            self.connectTimer = timerQueue.schedule(connectTimeout,
+                                                    self.connectTimedOut)
+        setInterest(sock, READ, self)
+
+    def connectTimedOut(self):
+        if self.sock in self.pool.connecting:
+            log.warning("Pool connect to %s timed out", self.pool.saddr)
+            self.pool.discard(self.sock, True)
+
+    def doSend(self):           # writable: the connect finished
+        if self.connectTimer:
+            self.connectTimer.cancel()
+        err = self.sock.getsockopt(SOL_SOCKET, SO_ERROR)
+        if err:
+            log.warning("Pool connect to %s failed: %s", self.pool.saddr,
+                        os.strerror(err))
+            self.pool.discard(self.sock, True)
+        else:
+            self.pool.connected(self.sock)
+
+    def doRecv(self):
+        if self.sock in self.pool.connecting:   # connect failed
+            self.doSend()
+            return
+        try:                    # idle pooled socket readable: EOF or data?
+            spoke = self.sock.recv(1, MSG_PEEK)
+        except BlockingIOError:
+            return
+        except OSError:
+            spoke = b""
+        if spoke:               # server speaks first: the Conn forwards it
+            setInterest(self.sock, READ, None)
+        else:                   # server left
+            self.pool.discard(self.sock, False)
+
+
+class Conn(reactor.Conn):
+    __slots__ = ("backend",)
+    fwdClass = SpliceFwd if splice else Fwd
+
+    def __init__(self, csock, caddr, listener, backend):
+        super().__init__(csock, caddr, listener)
+        self.backend = backend
+        backend.active += 1
+        ssock = backend.pool.take() if backend.pool else None  # pre-connected
+        addr = backend.address()    # cached: never resolves here
+        log.conn("New connection #%d from %s to %s", self.connIndex, caddr,
+                 backend)
+        if addr is None and ssock is None:
+            log.warning("Backend %s has no address yet", backend)
+            backend.failed()
+            self.die()
+            return
+        family, sockaddr = addr
+        if not self.connect(sockaddr, family, ssock=ssock):
+            backend.failed()
             self.die()
+        elif ssock:
+            self.startForwarding()
+        else:                   # forward once doSend sees the connect finish
+            setInterest(self.ssock, WRITE, self)
+
+    def doSend(self):           # server socket writable: the connect finished
+        setInterest(self.ssock, WRITE, None)
+        err = self.ssock.getsockopt(SOL_SOCKET, SO_ERROR)
+        if err:
+            log.warning("Connect to %s failed: %s", self.backend,
+                        os.strerror(err))
+            self.doErr(self.ssock)
+        else:
+            self.backend.succeeded()    # long-lived connections count too
+            self.startForwarding()
 
-    def die(self):
-        print(f"Connection {self.connIndex} shutting down")
-        for s in self.ssock, self.csock:
-            del sockNames[s]
-            try:
-                s.close()
-            except Exception as e:
-                print(f"close exception {e}")
-                pass
-        connections.remove(self)
-
-    def doErr(self):
-        print(f"Forwarder from client {self.caddr} failing due to error")
-        self.die()
-
-
-class Listener:
-    def __init__(self, bindaddr, saddr, addrFamily=AF_INET,
-                 socktype=SOCK_STREAM):  # saddr is address of server
-        self.bindaddr, self.saddr = bindaddr, saddr
-        self.addrFamily, self.socktype = addrFamily, socktype
-        self.lsock = lsock = socket(addrFamily, socktype)
-        sockNames[lsock] = "listener"
-        lsock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-        lsock.bind(bindaddr)
-        lsock.setblocking(False)
-        lsock.listen(2)
+    def startForwarding(self):
+        self.forward(self.csock, self.ssock, C2S)
+        self.forward(self.ssock, self.csock, S2C)
 
-    def doRecv(self):
-        try:
-            csock, caddr = self.lsock.accept()  # socket connected to client
-            Conn(csock, caddr, self.addrFamily, self.socktype, self.saddr)
-        except:
-            print("Weird, listener readable but can't accept!")
-            traceback.print_exc(file=sys.stdout)
+    def describeServer(self):
+        return self.backend
 
-    def doErr(self):
-        print("Listener socket failed!")
-        sys.exit(2)
+    def done(self):
+        self.backend.succeeded()
 
-    def checkRead(self):
-        return self.lsock
+    def die(self):
+        self.backend.active -= 1
+        super().die()
 
-    def checkWrite(self):
-        return None
+    def doErr(self, sock):
+        if sock is self.ssock and self.backend.available(time.monotonic()):
+            self.backend.failed()
+        super().doErr(sock)
 
-    def checkErr(self):
-        return self.lsock
 
+def gauges():                   # scrape-time view of the live connections
+    active = [0, 0]
+    buffered = [0, 0]
+    capacity = [0, 0]
+    for conn in connections:
+        for fwd in conn.forwarders:
+            active[fwd.direction] += 1
+            buffered[fwd.direction] += fwd.buffered()
+            capacity[fwd.direction] += fwd.bufCap
+    return (
+        ("proxy_active_connections", "Client connections open",
+         [({}, len(connections))]),
+        ("proxy_active_forwarders", "Directions still forwarding",
+         [({"direction": directionNames[d]}, active[d]) for d in (C2S, S2C)]),
+        ("proxy_buffered_bytes", "Bytes held in forwarder buffers",
+         [({"direction": directionNames[d]}, buffered[d]) for d in (C2S, S2C)]),
+        ("proxy_buffer_capacity_bytes", "Capacity of the forwarder buffers",
+         [({"direction": directionNames[d]}, capacity[d]) for d in (C2S, S2C)]),
+        ("proxy_backend_active_connections", "Connections per backend",
+         [({"backend": str(b)}, b.active) for b in serverList]),
+        ("proxy_backend_ejected", "1 if the backend is currently ejected",
+         [({"backend": str(b)}, int(not b.available(time.monotonic())))
+          for b in serverList]),
+        )
+
+
+class MetricsConn:              # one HTTP request for the metrics endpoint
+    def __init__(self, sock):
+        self.sock, self.request, self.reply = sock, b"", None
+        sock.setblocking(False)
+        setInterest(sock, READ, self)
 
-l = Listener(("0.0.0.0", listenPort), (serverHost, serverPort))
+    def doRecv(self):
+        try:
+            b = self.sock.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            b = b""
+        self.request += b
+        if not b or len(self.request) > 65536:
+            self.close()
+        elif b"\r\n\r\n" in self.request:
+            body = stats.render(gauges()).encode()
+            self.reply = memoryview(
+                b"HTTP/1.0 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                b"Content-Length: %d\r\n\r\n" % len(body) + body)
+            setInterest(self.sock, READ, None)
+            setInterest(self.sock, WRITE, self)
 
+    def doSend(self):
+        try:
+            n = self.sock.send(self.reply)
+        except BlockingIOError:
+            return
+        except OSError:
+            n = len(self.reply)
+        self.reply = self.reply[n:]
+        if not self.reply:
+            self.close()
+
+    def close(self):
+        forget(self.sock)
+        self.sock.close()
+
+
+class MetricsListener:          # serves stats on its own port, same loop
+    def __init__(self, bindaddr, lsock=None):
+        if lsock is None:
+            lsock = socket(AF_INET, SOCK_STREAM)
+            lsock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+            lsock.bind(bindaddr)
+            lsock.listen(8)
+        self.lsock = lsock
+        lsock.setblocking(False)
+        setInterest(lsock, READ, self)
 
-def lookupSocknames(socks):
-    return [sockNames[s] for s in socks]
+    def close(self):
+        forget(self.lsock)
+        self.lsock.close()
 
-while 1:
-    rmap, wmap, xmap = {}, {}, {}   # socket:object mappings for select
-    xmap[l.checkErr()] = l
-    rmap[l.checkRead()] = l
-    for conn in connections:
-        for sock in conn.csock, conn.ssock:
-            xmap[sock] = conn
-            for fwd in conn.forwarders:
-                sock = fwd.checkRead()
-                if (sock):
-                    rmap[sock] = fwd
-                sock = fwd.checkWrite()
-                if (sock):
-                    wmap[sock] = fwd
-    rset, wset, xset = select(list(rmap.keys()), list(wmap.keys()),
-                              list(xmap.keys()), 60)
-    # print "select r=%s, w=%s, x=%s" %
-    if debug:
-        print(
-            "ready sockets: ",
-            [[sockNames[s] for s in sset] for sset in [rset, wset, xset]]
-            )
-    for sock in rset:
-        rmap[sock].doRecv()
-    for sock in wset:
-        wmap[sock].doSend()
-    for sock in xset:
-        xmap[sock].doErr()
+    def doRecv(self):
+        try:
+            MetricsConn(self.lsock.accept()[0])
+        except OSError:
+            pass
+
+
+balancer = backends.strategies[paramMap['balance']](serverList)
+
+if engine == "asyncio":
+    import aioProxy
+    aioProxy.run(("0.0.0.0", listenPort), balancer, bufCap, connectTimeout,
+                 idleTimeout, reuse_port=numWorkers > 1, backlog=backlog)
+    sys.exit(0)
+
+inherited = {}                  # listening sockets of the process we replace
+if handoffFd is not None:
+    channel, inherited = handoff.inherit(handoffFd)
+listeners = {}
+l = listeners["proxy"] = Listener(
+    ("0.0.0.0", listenPort),
+    lambda csock, caddr, listener: Conn(csock, caddr, listener,
+                                        balancer.pick(caddr)),
+    reusePort=numWorkers > 1, clientOpts=clientOpts, serverOpts=serverOpts,
+    lsock=inherited.get("proxy"))
+if poolSize:
+    for backend in serverList:
+        backend.pool = UpstreamPool(backend, l.socktype, poolSize, serverOpts)
+        backend.pool.fill()
+if metricsPort:
+    listeners["metrics"] = MetricsListener(("127.0.0.1", metricsPort),
+                                           inherited.get("metrics"))
+reactor.onSignal(signal.SIGTERM, reactor.stop)
+if hotRestart:
+    reactor.onSignal(signal.SIGHUP,
+                     handoff.Handoff(listeners, drainTimeout).start)
+if loopProfile:
+    reactor.onSignal(signal.SIGUSR1, loopProfile.dump)
+else:                           # don't let a stray SIGUSR1 kill the proxy
+    reactor.onSignal(signal.SIGUSR1, lambda: log.warning(
+        "No loop profile to dump: start with --loopStats"))
+reactor.onSignal(signal.SIGUSR2, ProfileWindow(profileWindow).toggle)
+if handoffFd is not None:
+    handoff.ready(channel)      # the old process stops accepting now
+
+reactor.run(60)
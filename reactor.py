@@ -0,0 +1,955 @@
+# Event-loop core shared by proxy.py, stammerProxy.py and echoServer.py.
+#
+# One selector and one timer heap per process.  A Conn owns a client socket
+# (and usually a server socket) plus one forwarder per direction; a Listener
+# turns accepted sockets into Conns; run() dispatches readiness events to
+# whichever handler currently wants them.
+#
+# A forwarder with no filters is the fast path: recv_into a reusable buffer
+# and send straight from it (or splice in the kernel), with no per-chunk
+# work beyond counting bytes.  Given filters, a FilteredFwd passes every
+# chunk read through them in order before queueing it for output; a filter
+# may change, hold back or delay data, emitting it later from a timer.
+#
+# Small writes can be coalesced: while fewer than flushBytes are waiting,
+# a forwarder holds them back for up to flushDelay seconds in case more
+# arrive, so chatty streams go out in fewer sends and packets.  A
+# FilteredFwd queues the chunks its filters emit without copying them and
+# sends as many as it can with one sendmsg().
+#
+# Given a capture (capture.CaptureFile), forwarders record every chunk
+# they read, and Conns their opening and closing, for replay.py.
+#
+# Per-connection state is kept small for large fleets of idle clients: the
+# classes use __slots__, socket names are made up only when logged, and a
+# forwarder has no buffer until data arrives (and frees a minimum-size one
+# again once its connection has been idle for releaseAfter seconds).
+#
+# Signal handlers only queue work (onSignal): run() does it once select()
+# returns, never in the middle of updating the selector, a timer or a
+# connection.  stop() makes run() return.
+#
+# Import this module after forking worker processes: each needs its own
+# selector.
+from collections import deque
+from errno import EINPROGRESS, EMFILE, ENFILE
+from itertools import islice
+import os
+from selectors import EVENT_READ, EVENT_WRITE, DefaultSelector
+import signal
+from socket import (AF_INET, IPPROTO_TCP, SHUT_WR, SO_LINGER, SO_REUSEADDR,
+                    SO_REUSEPORT, SOCK_STREAM, SOL_SOCKET, socket, socketpair)
+try:
+    from socket import TCP_CORK, TCP_QUICKACK
+except ImportError:             # not Linux: sockOpts never asks for these
+    TCP_CORK = TCP_QUICKACK = None
+import struct
+import sys
+import time
+
+from capture import CLOSE, OPEN
+from metrics import C2S, Metrics
+from ringLog import DEBUG, log
+from sockOpts import SockOpts
+import timers
+
+nextConnectionNumber = 0     # each connection is assigned a unique id
+stats = Metrics()            # cheap counters, always collected
+connections = set()
+
+sel = DefaultSelector()      # sockets stay registered; only interest changes
+timerQueue = timers.TimerQueue()
+READ, WRITE = 0, 1           # index of handler in a registration's data
+
+bufCap, bufMin = 262144, 4096   # forwarder buffer bounds, per direction
+connectTimeout = idleTimeout = 0  # seconds; 0 = none
+backlog = 1024               # listen() queue length
+acceptBatch = 64             # most connections accepted per wakeup
+maxConns = 0                 # concurrent connections; 0 = unlimited
+acceptRate = 0               # connections accepted per second; 0 = unlimited
+fdRetryDelay = 0.1           # seconds paused when out of file descriptors
+overload = "queue"           # over a limit: "queue" in the backlog or "refuse"
+flushBytes = 0               # hold smaller writes back; 0 = send at once
+flushDelay = 0.001           # seconds a write is held back at most
+capture = None               # CaptureFile recording what is forwarded
+loopProfile = None           # loopProfile.LoopProfile timing run()'s phases
+
+settingNames = ("bufCap", "bufMin", "connectTimeout", "idleTimeout",
+                "backlog", "acceptBatch", "maxConns", "acceptRate", "overload",
+                "flushBytes", "flushDelay", "capture", "loopProfile")
+try:
+    iovMax = os.sysconf("SC_IOV_MAX")   # most chunks one sendmsg() takes
+except (AttributeError, ValueError, OSError):
+    iovMax = 16
+waitingForSlot = set()       # listeners paused until a connection closes
+signalled = deque()          # actions queued by signal handlers for run()
+waker = None                 # wakes select() when a signal arrives
+running = True               # cleared by stop()
+
+
+def configure(**settings):
+    """Set any of the module settings named in settingNames"""
+    for name, value in settings.items():
+        if name not in settingNames:
+            raise TypeError(f"unknown setting {name}")
+        globals()[name] = value
+
+
+def setInterest(sock, which, handler):
+    """Set (or clear, if handler is None) the READ or WRITE handler of sock.
+
+    The selector is only touched when the resulting event mask changes."""
+    try:
+        key = sel.get_key(sock)
+        handlers, oldMask = key.data, key.events
+    except KeyError:
+        if handler is None:
+            return
+        handlers, oldMask = [None, None], 0
+    handlers[which] = handler
+    mask = ((EVENT_READ if handlers[READ] else 0) |
+            (EVENT_WRITE if handlers[WRITE] else 0))
+    if mask == oldMask:
+        return
+    if not mask:
+        sel.unregister(sock)
+    elif oldMask:
+        sel.modify(sock, mask, handlers)
+    else:
+        sel.register(sock, mask, handlers)
+
+
+def describe(key):              # name of a registered socket, for debugging
+    handler = key.data[READ] or key.data[WRITE]
+    conn = getattr(handler, "conn", None)
+    if conn is not None:
+        return conn.sockName(key.fileobj)
+    return type(handler).__name__
+
+
+def forget(sock):
+    """Drop sock from the selector (call before closing it)"""
+    try:
+        key = sel.unregister(sock)
+    except (KeyError, ValueError):
+        return
+    key.data[:] = [None, None]  # events already fetched must not fire
+
+
+def onSignal(signum, action):
+    """Have run() call action() when signum arrives.
+
+    Python runs a handler between any two bytecodes, wherever the loop is,
+    so the handler only queues action; the wakeup fd makes a select() that
+    is waiting return at once."""
+    global waker
+    if waker is None:
+        waker = Waker()
+    signal.signal(signum, lambda signum, frame: signalled.append(action))
+
+
+def stop():
+    """Make run() return once the events in hand are dispatched"""
+    global running
+    running = False
+
+
+class Waker:                    # signal.set_wakeup_fd writes to its socketpair
+    def __init__(self):
+        self.rsock, self.wsock = socketpair()
+        self.rsock.setblocking(False)
+        self.wsock.setblocking(False)
+        signal.set_wakeup_fd(self.wsock.fileno(), warn_on_full_buffer=False)
+        setInterest(self.rsock, READ, self)
+
+    def doRecv(self):           # the actions themselves run from run()
+        try:
+            while self.rsock.recv(64):
+                pass
+        except BlockingIOError:
+            pass
+
+
+def runSignalled():           # from run(), after timers.now is refreshed
+    while signalled:
+        signalled.popleft()()
+
+
+class Fwd:
+    # The buffer starts at bufMin bytes and, like TCP receive autotuning,
+    # doubles (up to bufMax) when reads keep filling it, so bulk flows move
+    # more bytes per syscall.  Once a grown buffer has seen no full read for
+    # shrinkAfter seconds it is halved again, one step per period; once an
+    # empty minimum-size one has been idle for releaseAfter it is freed.
+    # One timer, armed when the buffer is allocated or grown, does both.
+    __slots__ = ("inSock", "outSock", "conn", "direction", "inClosed",
+                 "buf", "view", "start", "end", "bufCap", "bufMin", "bufMax",
+                 "fullReads", "lastFull", "shrinkTimer", "cork", "corked",
+                 "quickAck", "flushTimer", "flushDue")
+    growAfter = 2               # consecutive full reads before growing
+    shrinkAfter = 1.0           # seconds without a full read before shrinking
+    releaseAfter = 5.0          # seconds idle before freeing the buffer
+
+    def __init__(self, conn, inSock, outSock, bufCap=65536, direction=C2S,
+                 bufMin=None):
+        self.inSock, self.outSock = inSock, outSock
+        self.conn, self.bufMax = conn, bufCap
+        self.bufMin = bufCap if bufMin is None else min(bufMin, bufCap)
+        self.direction = direction
+        self.inClosed = 0
+        self.buf = self.view = None   # allocated when data arrives
+        self.bufCap = self.bufMin
+        self.start = self.end = 0     # unsent data is buf[start:end]
+        self.fullReads = 0      # consecutive reads that filled the buffer
+        self.lastFull = 0       # timers.now of the last full read
+        self.shrinkTimer = None
+        self.cork = self.corked = False   # hold partial segments while queued
+        self.quickAck = False   # ACK input at once (re-armed after each read)
+        self.flushTimer = None  # coalescing: when held-back data must go
+        self.flushDue = False
+
+    def resize(self, cap):      # new buffer of cap bytes, keeping unsent data
+        n = self.end - self.start
+        if n == 0 and cap == self.bufMin:
+            buf = view = None   # nothing queued: allocate on the next read
+        else:
+            buf = bytearray(cap)    # preallocated, reused for every chunk
+            buf[:n] = self.view[self.start:self.end]
+            view = memoryview(buf)
+        self.buf, self.view, self.bufCap = buf, view, cap
+        self.start, self.end = 0, n
+
+    def updateInterest(self):
+        setInterest(self.inSock, READ, self if self.checkRead() else None)
+        setInterest(self.outSock, WRITE, self if self.checkWrite() else None)
+
+    def checkRead(self):
+        if self.end - self.start < self.bufCap and not self.inClosed:
+            return self.inSock
+        else:
+            return None
+
+    def checkWrite(self):
+        pending = self.end - self.start
+        if not pending:
+            return None
+        if pending < min(flushBytes, self.bufCap) and not (
+                self.flushDue or self.inClosed):
+            self.holdOutput()
+            return None
+        return self.outSock
+
+    def holdOutput(self):       # wait for more, but no longer than flushDelay
+        if not self.flushTimer:
+            self.flushTimer = timerQueue.schedule(flushDelay, self.flush)
+
+    def flush(self):
+        self.flushTimer = None
+        self.flushDue = True
+        self.updateInterest()
+
+    def doRecv(self):
+        if self.buf is None:
+            self.buf = bytearray(self.bufCap)
+            self.view = memoryview(self.buf)
+            if not self.shrinkTimer:
+                self.shrinkTimer = timerQueue.schedule(self.releaseAfter,
+                                                       self.checkShrink)
+        elif self.end == self.bufCap:   # no room at the tail: slide data down
+            n = self.end - self.start
+            self.buf[:n] = self.buf[self.start:self.end]
+            self.start, self.end = 0, n
+        room = self.bufCap - self.end
+        try:
+            n = self.inSock.recv_into(self.view[self.end:])
+        except BlockingIOError:
+            return
+        except OSError:
+            self.conn.doErr(self.inSock)
+            return
+        if capture:             # n == 0 records the EOF
+            capture.record(timers.now, self.conn.connIndex, self.direction,
+                           self.view[self.end:self.end + n])
+        if n:                   # read something
+            self.end += n
+            self.conn.lastActive = timers.now
+            stats.bytesIn[self.direction] += n
+            if self.quickAck:
+                self.rearmQuickAck()
+            if n == room and room << 1 >= self.bufCap:
+                self.sawFullRead()
+            else:
+                self.fullReads = 0
+        else:                   # zero length read (input closed)
+            self.inClosed = 1
+        self.checkDone()
+
+    def sawFullRead(self):      # more was waiting: this direction is saturated
+        self.lastFull = timers.now
+        self.fullReads += 1
+        if self.fullReads >= self.growAfter and self.bufCap < self.bufMax:
+            self.fullReads = 0
+            self.resize(min(self.bufCap << 1, self.bufMax))
+            stats.bufferResizes += 1
+            shrinkAt = timers.now + self.shrinkAfter
+            timer = self.shrinkTimer
+            if timer and timer.when > shrinkAt:     # the release timer
+                timer.cancel()
+                timer = None
+            if not timer:
+                self.shrinkTimer = timerQueue.scheduleAt(shrinkAt,
+                                                         self.checkShrink)
+
+    def checkShrink(self):      # shrink timer: re-armed while still busy
+        self.shrinkTimer = None
+        if self.bufCap > self.bufMin:
+            quietFor = timers.now - self.lastFull
+            if quietFor < self.shrinkAfter:
+                delay = self.shrinkAfter - quietFor
+            else:
+                cap = max(self.bufCap >> 1, self.bufMin)
+                if self.end - self.start <= cap:
+                    self.resize(cap)
+                    stats.bufferResizes += 1
+                delay = self.shrinkAfter
+        else:                   # minimum size: free it once idle and empty
+            idleFor = timers.now - self.conn.lastActive
+            if idleFor >= self.releaseAfter and self.start == self.end:
+                self.buf = self.view = None
+            delay = max(self.releaseAfter - idleFor, self.shrinkAfter)
+        if self.buf is not None:
+            self.shrinkTimer = timerQueue.schedule(delay, self.checkShrink)
+
+    def doSend(self):
+        try:
+            n = self.outSock.send(self.view[self.start:self.end])
+        except BlockingIOError:
+            return
+        except OSError:
+            self.conn.doErr(self.outSock)
+            return
+        self.start += n
+        self.conn.lastActive = timers.now
+        stats.bytesOut[self.direction] += n
+        if self.flushTimer:     # what it was waiting for has gone out
+            self.flushTimer.cancel()
+            self.flushTimer = None
+        if self.start == self.end:    # drained: refill from the front
+            self.start = self.end = 0
+            self.flushDue = False
+        if self.cork:
+            self.setCork(self.start != self.end)
+        self.checkDone()
+
+    def rearmQuickAck(self):    # the kernel leaves quick-ACK mode by itself
+        try:
+            self.inSock.setsockopt(IPPROTO_TCP, TCP_QUICKACK, 1)
+        except OSError:
+            pass
+
+    def setCork(self, on):      # only touch the socket when the state flips
+        if on != self.corked:
+            self.corked = on
+            try:
+                self.outSock.setsockopt(IPPROTO_TCP, TCP_CORK, on)
+            except OSError:
+                pass
+
+    def checkDone(self):
+        self.updateInterest()
+        if self.end == self.start and self.inClosed:
+            try:
+                self.outSock.shutdown(SHUT_WR)
+            except OSError:
+                pass
+            self.close()
+            self.conn.fwdDone(self)
+
+    def buffered(self):
+        return self.end - self.start
+
+    def close(self):            # release resources held outside the buffer
+        for timer in self.shrinkTimer, self.flushTimer:
+            if timer:
+                timer.cancel()
+        self.shrinkTimer = self.flushTimer = None
+
+
+class SpliceFwd(Fwd):
+    """Fwd that moves data socket->pipe->socket with os.splice.
+
+    The payload never enters user space; only byte counts do.  The pipe
+    is opened when data first arrives."""
+    __slots__ = ("pipeR", "pipeW", "inPipe")
+
+    def __init__(self, conn, inSock, outSock, bufCap=65536, direction=C2S,
+                 bufMin=None):  # the pipe is sized once; bufMin is unused
+        self.inSock, self.outSock = inSock, outSock
+        self.conn, self.bufCap = conn, bufCap
+        self.direction = direction
+        self.inClosed = 0
+        self.pipeR = self.pipeW = -1
+        self.inPipe = 0         # bytes spliced into the pipe but not out
+        self.cork = self.corked = False
+        self.quickAck = False
+
+    def openPipe(self):
+        self.pipeR, self.pipeW = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        try:                    # never ask for more than the pipe holds
+            from fcntl import F_GETPIPE_SZ, F_SETPIPE_SZ, fcntl
+            try:
+                fcntl(self.pipeW, F_SETPIPE_SZ, self.bufCap)
+            except OSError:
+                pass            # over pipe-max-size: keep the default
+            self.bufCap = min(self.bufCap, fcntl(self.pipeW, F_GETPIPE_SZ))
+        except ImportError:
+            self.bufCap = min(self.bufCap, 65536)
+
+    def checkRead(self):
+        if self.inPipe < self.bufCap and not self.inClosed:
+            return self.inSock
+        else:
+            return None
+
+    def checkWrite(self):
+        if self.inPipe > 0:
+            return self.outSock
+        else:
+            return None
+
+    def doRecv(self):
+        try:
+            if self.pipeR < 0:
+                self.openPipe()
+            n = os.splice(self.inSock.fileno(), self.pipeW,
+                          self.bufCap - self.inPipe,
+                          flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.conn.doErr(self.inSock)
+            return
+        if n:
+            self.inPipe += n
+            self.conn.lastActive = timers.now
+            stats.bytesIn[self.direction] += n
+            if self.quickAck:
+                self.rearmQuickAck()
+        else:                   # zero length splice (input closed)
+            self.inClosed = 1
+        self.checkDone()
+
+    def doSend(self):
+        try:
+            n = os.splice(self.pipeR, self.outSock.fileno(), self.inPipe,
+                          flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.conn.doErr(self.outSock)
+            return
+        self.inPipe -= n
+        self.conn.lastActive = timers.now
+        stats.bytesOut[self.direction] += n
+        if self.cork:
+            self.setCork(self.inPipe > 0)
+        self.checkDone()
+
+    def checkDone(self):
+        self.updateInterest()
+        if self.inPipe == 0 and self.inClosed:
+            try:
+                self.outSock.shutdown(SHUT_WR)
+            except OSError:
+                pass
+            self.close()
+            self.conn.fwdDone(self)
+
+    def close(self):
+        if self.pipeR >= 0:
+            os.close(self.pipeR)
+            os.close(self.pipeW)
+            self.pipeR = self.pipeW = -1
+
+    def buffered(self):
+        return self.inPipe
+
+
+class Filter:
+    """One stage of a FilteredFwd's pipeline.
+
+    push() gets every chunk in stream order and passes data on with
+    self.emit(), now or later; finish() is called at end of input and must
+    (eventually) call self.next.finish().  held() is the number of bytes
+    the filter is holding back, which counts against the forwarder's
+    buffer capacity.  drained() is called whenever the output buffer has
+    been emptied.  Emitted data is queued, not copied, so it must not be
+    changed afterwards.  self.fwd and self.next are set by the forwarder."""
+    fwd = next = None
+
+    def push(self, data):
+        self.emit(data)
+
+    def emit(self, data):
+        self.next.push(data)
+
+    def finish(self):
+        self.next.finish()
+
+    def held(self):
+        return 0
+
+    def drained(self):
+        pass
+
+    def close(self):            # the connection is gone: cancel timers
+        pass
+
+
+class FilteredFwd:
+    __slots__ = ("inSock", "outSock", "conn", "bufCap", "direction",
+                 "inClosed", "outClosed", "closed", "out", "outBytes",
+                 "filters", "flushTimer", "flushDue")
+
+    def __init__(self, conn, inSock, outSock, filters, bufCap=65536,
+                 direction=C2S):
+        self.inSock, self.outSock = inSock, outSock
+        self.conn, self.bufCap = conn, bufCap
+        self.direction = direction
+        self.inClosed = 0       # no more input will be read
+        self.outClosed = 0      # the last filter has finished
+        self.closed = False
+        self.out = deque()      # filtered chunks waiting to be sent
+        self.outBytes = 0
+        self.flushTimer = None  # coalescing, as in Fwd
+        self.flushDue = False
+        self.filters = filters
+        for i, f in enumerate(filters):
+            f.fwd = self
+            f.next = filters[i + 1] if i + 1 < len(filters) else self
+
+    def updateInterest(self):
+        setInterest(self.inSock, READ, self if self.checkRead() else None)
+        setInterest(self.outSock, WRITE, self if self.checkWrite() else None)
+
+    def checkRead(self):
+        if self.buffered() < self.bufCap and not self.inClosed:
+            return self.inSock
+        else:
+            return None
+
+    def checkWrite(self):
+        if not self.out:
+            return None
+        if self.outBytes < min(flushBytes, self.bufCap) and not (
+                self.flushDue or self.outClosed):
+            self.holdOutput()
+            return None
+        return self.outSock
+
+    def holdOutput(self):
+        if not self.flushTimer:
+            self.flushTimer = timerQueue.schedule(flushDelay, self.flush)
+
+    def flush(self):
+        self.flushTimer = None
+        self.flushDue = True
+        self.updateInterest()
+
+    def push(self, data):       # output of the last filter
+        if data:
+            self.out.append(data)
+            self.outBytes += len(data)
+        self.updateInterest()
+
+    def finish(self):
+        self.outClosed = 1
+        self.checkDone()
+
+    def doRecv(self):
+        try:
+            b = self.inSock.recv(self.bufCap - self.buffered())
+        except BlockingIOError:
+            return
+        except OSError:
+            self.conn.doErr(self.inSock)
+            return
+        if capture:
+            capture.record(timers.now, self.conn.connIndex, self.direction, b)
+        if b:
+            self.conn.lastActive = timers.now
+            stats.bytesIn[self.direction] += len(b)
+            self.filters[0].push(b)
+            self.updateInterest()
+        else:                   # zero length read (input closed)
+            self.inClosed = 1
+            self.updateInterest()
+            self.filters[0].finish()
+
+    def doSend(self):
+        out = self.out
+        try:
+            if len(out) > 1:    # gather the queued chunks into one call
+                n = self.outSock.sendmsg(islice(out, iovMax))
+            else:
+                n = self.outSock.send(out[0])
+        except BlockingIOError:
+            return
+        except OSError:
+            self.conn.doErr(self.outSock)
+            return
+        self.outBytes -= n
+        self.conn.lastActive = timers.now
+        stats.bytesOut[self.direction] += n
+        while n:
+            chunk = out[0]
+            if n < len(chunk):  # partly sent: keep the rest, uncopied
+                out[0] = memoryview(chunk)[n:]
+                break
+            out.popleft()
+            n -= len(chunk)
+        if self.flushTimer:
+            self.flushTimer.cancel()
+            self.flushTimer = None
+        if not out:
+            self.flushDue = False
+            for f in self.filters:
+                f.drained()
+        self.checkDone()
+
+    def checkDone(self):
+        if self.closed:         # a filter already finished us
+            return
+        self.updateInterest()
+        if not self.out and self.outClosed:
+            try:
+                self.outSock.shutdown(SHUT_WR)
+            except OSError:
+                pass
+            self.close()
+            self.conn.fwdDone(self)
+
+    def buffered(self):
+        return self.outBytes + sum(f.held() for f in self.filters)
+
+    def close(self):
+        self.closed = True
+        if self.flushTimer:
+            self.flushTimer.cancel()
+            self.flushTimer = None
+        for f in self.filters:
+            f.close()
+
+
+class Conn:
+    """A client socket, optionally a server socket, and their forwarders.
+
+    Subclasses should declare __slots__ too, or every Conn gets a __dict__."""
+    __slots__ = ("csock", "ssock", "saddr", "listener", "connIndex",
+                 "connectTimer", "idleTimer", "lastActive", "forwarders")
+    fwdClass = Fwd              # forwarder used when there are no filters
+
+    def __init__(self, csock, caddr, listener=None):
+        global nextConnectionNumber
+        self.csock = csock      # to client (caddr is only used for logging)
+        self.listener = listener    # has the socket options for each side
+        self.ssock = self.saddr = None          # to server, if any
+        self.connIndex = connIndex = nextConnectionNumber
+        nextConnectionNumber += 1
+        self.connectTimer = self.idleTimer = None
+        self.lastActive = timers.now
+        if idleTimeout:
+            self.idleTimer = timerQueue.schedule(idleTimeout, self.checkIdle)
+        self.forwarders = []
+        if capture:
+            capture.record(timers.now, connIndex, OPEN)
+        csock.setblocking(False)
+        connections.add(self)
+
+    def connect(self, saddr, af=AF_INET, socktype=SOCK_STREAM, ssock=None):
+        """Start connecting to saddr (unless ssock is already connected).
+
+        Returns False if the connect failed outright."""
+        self.saddr = saddr
+        ok = True
+        if ssock is None:
+            ssock = socket(af, socktype)
+            ssock.setblocking(False)
+            if self.listener:   # before connecting: buffer sizes matter then
+                self.listener.serverOpts.apply(ssock)
+            ok = ssock.connect_ex(saddr) in (0, EINPROGRESS)
+            if ok and connectTimeout:
+                self.connectTimer = timerQueue.schedule(connectTimeout,
+                                                        self.checkConnected)
+        self.ssock = ssock
+        return ok
+
+    def forward(self, inSock, outSock, direction=C2S, filters=None, cap=None):
+        """Start forwarding inSock to outSock through filters (if any)"""
+        cap = cap or bufCap
+        if filters:
+            fwd = FilteredFwd(self, inSock, outSock, filters, cap, direction)
+        else:
+            fwd = self.fwdClass(self, inSock, outSock, cap, direction, bufMin)
+            if self.listener:
+                fwd.cork = self.sockOpts(outSock).cork
+                fwd.quickAck = self.sockOpts(inSock).quickAck
+        self.forwarders.append(fwd)
+        fwd.updateInterest()
+        return fwd
+
+    def sockOpts(self, sock):   # the listener's options for sock's side
+        if sock is self.csock:
+            return self.listener.clientOpts
+        return self.listener.serverOpts
+
+    def fwdDone(self, forwarder):
+        forwarders = self.forwarders
+        forwarders.remove(forwarder)
+        log.conn("Forwarder %s ==> %s from connection %d shutting down",
+                 self.sockName(forwarder.inSock),
+                 self.sockName(forwarder.outSock), self.connIndex)
+        if len(forwarders) == 0:
+            self.done()
+            self.die()
+
+    def done(self):             # every direction finished cleanly
+        pass
+
+    def sockName(self, sock):   # made up on demand rather than stored
+        kind = "Clnt" if sock is self.csock else "Srvr"
+        return f"To{kind}.{self.connIndex}"
+
+    def checkConnected(self):   # connect timer: has the server answered?
+        self.connectTimer = None
+        try:
+            self.ssock.getpeername()
+        except OSError:
+            log.warning("Connection %d: no answer from %s within %ss",
+                        self.connIndex, self.describeServer(), connectTimeout)
+            self.doErr(self.ssock)
+
+    def describeServer(self):
+        return self.saddr
+
+    def checkIdle(self):        # idle timer: re-armed unless truly idle
+        idleFor = timers.now - self.lastActive
+        if idleFor < idleTimeout:
+            self.idleTimer = timerQueue.schedule(idleTimeout - idleFor,
+                                                 self.checkIdle)
+        else:
+            self.idleTimer = None
+            log.conn("Connection %d idle for %ss, closing", self.connIndex,
+                     idleTimeout)
+            self.die()
+
+    def die(self):
+        log.conn("Connection %d shutting down", self.connIndex)
+        for timer in self.connectTimer, self.idleTimer:
+            if timer:
+                timer.cancel()
+        stats.closedTotal += 1
+        if capture:
+            capture.record(timers.now, self.connIndex, CLOSE)
+        for s in self.ssock, self.csock:
+            if s is None:
+                continue
+            forget(s)
+            try:
+                s.close()
+            except Exception as e:
+                log.warning("close exception %s", e)
+        for fwd in self.forwarders:
+            fwd.close()
+        connections.remove(self)
+        for listener in list(waitingForSlot):  # a slot is free: accept again
+            listener.resume()
+
+    def doErr(self, sock):
+        log.warning("Forwarder %s of connection %d failing due to error",
+                    self.sockName(sock), self.connIndex)
+        self.die()
+
+
+class Listener:                 # a listener socket is a factory for established connections
+    # Each wakeup accepts until the backlog is empty or acceptBatch
+    # connections have been taken.  Past maxConns or acceptRate, the
+    # listener either stops watching its socket (overload "queue": clients
+    # wait in the kernel's backlog, existing connections are unaffected)
+    # or accepts and immediately resets the newcomers ("refuse").  Out of
+    # file descriptors, it stops watching until a connection closes or
+    # fdRetryDelay has passed, rather than spin on a readable socket.
+    # clientOpts are applied to accepted sockets, serverOpts to the sockets
+    # their Conns open to servers.  Given lsock, an already listening socket
+    # (e.g. inherited from the process being replaced), it is used as is.
+    def __init__(self, bindaddr, newConn, addrFamily=AF_INET,
+                 socktype=SOCK_STREAM, reusePort=False, clientOpts=None,
+                 serverOpts=None, lsock=None):
+        self.bindaddr, self.newConn = bindaddr, newConn  # newConn(csock, caddr, listener)
+        self.addrFamily, self.socktype = addrFamily, socktype
+        self.clientOpts = clientOpts or SockOpts()
+        self.serverOpts = serverOpts or SockOpts()
+        if lsock is None:
+            lsock = socket(addrFamily, socktype)
+            lsock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+            if reusePort:       # share the port with other processes
+                lsock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+            self.clientOpts.applyToListener(lsock)
+            lsock.bind(bindaddr)
+            lsock.listen(backlog)
+        self.lsock = lsock
+        lsock.setblocking(False)
+        self.burst = max(acceptRate / 10, 1)   # accept-rate token bucket
+        self.tokens, self.stamp = self.burst, timers.now
+        self.resumeTimer = None
+        self.starved = False    # accept() last failed for want of descriptors
+        setInterest(lsock, READ, self)
+
+    def doRecv(self):
+        for i in range(acceptBatch):
+            limit = self.overLimit()
+            if limit and overload == "queue":
+                self.pause(limit)
+                return
+            try:
+                csock, caddr = self.lsock.accept()  # socket connected to client
+            except BlockingIOError:
+                return          # backlog drained
+            except OSError as e:
+                if e.errno in (EMFILE, ENFILE):
+                    if not self.starved:    # once, not on every retry
+                        self.starved = True
+                        log.error("Out of file descriptors, pausing accepts")
+                    self.pause("descriptors")
+                else:
+                    log.error("Weird, listener readable but can't accept! %r",
+                              e)
+                return
+            stats.acceptsTotal += 1
+            self.starved = False
+            if limit:
+                self.refuse(csock, caddr, limit)
+                continue
+            if acceptRate:
+                self.tokens -= 1
+            self.clientOpts.apply(csock)
+            try:
+                self.newConn(csock, caddr, self)
+            except Exception as e:
+                log.error("Can't set up connection from %s: %r", caddr, e)
+                self.abandon(csock)
+
+    def abandon(self, csock):   # newConn failed: undo what it set up
+        for conn in connections:
+            if conn.csock is csock:
+                conn.die()      # closes csock too
+                return
+        csock.close()
+
+    def overLimit(self):
+        """Which limit ("maxConns" or "acceptRate") stops the next accept"""
+        if maxConns and len(connections) >= maxConns:
+            return "maxConns"
+        if acceptRate:
+            now = timers.now
+            self.tokens = min(self.tokens + (now - self.stamp) * acceptRate,
+                              self.burst)
+            self.stamp = now
+            if self.tokens < 1:
+                return "acceptRate"
+        return None
+
+    def pause(self, limit):     # leave newcomers queued in the backlog
+        setInterest(self.lsock, READ, None)
+        if limit != "acceptRate":
+            waitingForSlot.add(self)    # resumed when a connection closes
+        if limit != "maxConns" and not self.resumeTimer:
+            delay = ((1 - self.tokens) / acceptRate if limit == "acceptRate"
+                     else fdRetryDelay)
+            self.resumeTimer = timerQueue.schedule(delay, self.resume)
+
+    def resume(self):
+        waitingForSlot.discard(self)
+        if self.resumeTimer:
+            self.resumeTimer.cancel()
+            self.resumeTimer = None
+        setInterest(self.lsock, READ, self)
+
+    def refuse(self, csock, caddr, limit):
+        stats.refusedTotal += 1
+        log.conn("Refused connection from %s (%s)", caddr, limit)
+        try:                    # reset rather than linger in TIME_WAIT
+            csock.setsockopt(SOL_SOCKET, SO_LINGER, struct.pack("ii", 1, 0))
+        except OSError:
+            pass
+        csock.close()
+
+    def close(self):            # stop accepting; the backlog stays queued
+        waitingForSlot.discard(self)    # if another process shares lsock
+        if self.resumeTimer:
+            self.resumeTimer.cancel()
+            self.resumeTimer = None
+        forget(self.lsock)
+        self.lsock.close()
+
+    def doErr(self):
+        log.error("Listener socket failed!")
+        log.flush()
+        sys.exit(2)
+
+
+def run(defaultTimeout=60):
+    """Dispatch events, timers and signalled actions until stop()"""
+    if loopProfile:
+        return runProfiled(defaultTimeout, loopProfile)
+    while running:
+        events = sel.select(timerQueue.timeout(defaultTimeout))
+        busyStart = time.perf_counter()
+        timerQueue.runDue()     # refreshes timers.now, then expired timers
+        runSignalled()
+        if log.isEnabled(DEBUG):
+            log.debug("ready sockets: %s",
+                      [(describe(key), mask) for key, mask in events])
+        for key, mask in events:
+            handlers = key.data
+            if mask & EVENT_READ and handlers[READ]:
+                handlers[READ].doRecv()
+            if mask & EVENT_WRITE and handlers[WRITE]:
+                handlers[WRITE].doSend()
+        stats.observeLoop(time.perf_counter() - busyStart)
+
+
+def runProfiled(defaultTimeout, profile):
+    """run(), timing every phase and handler call into profile"""
+    clock = time.perf_counter_ns
+    while running:
+        t0 = clock()
+        timeout = timerQueue.timeout(defaultTimeout)
+        t1 = clock()
+        events = sel.select(timeout)
+        t2 = clock()
+        timerQueue.runDue()
+        runSignalled()          # a dump reset()s the profile: fetch it after
+        phases, handlerHist = profile.phases, profile.handler
+        t3 = clock()
+        if log.isEnabled(DEBUG):
+            log.debug("ready sockets: %s",
+                      [(describe(key), mask) for key, mask in events])
+        for key, mask in events:
+            handlers = key.data
+            handler = handlers[READ]
+            if mask & EVENT_READ and handler:
+                start = clock()
+                handler.doRecv()
+                handlerHist(type(handler), READ).add(clock() - start)
+            handler = handlers[WRITE]
+            if mask & EVENT_WRITE and handler:
+                start = clock()
+                handler.doSend()
+                handlerHist(type(handler), WRITE).add(clock() - start)
+        t4 = clock()
+        phases["timeout"].add(t1 - t0)
+        phases["select"].add(t2 - t1)
+        phases["timers"].add(t3 - t2)
+        phases["busy"].add(t4 - t2)
+        stats.observeLoop((t4 - t2) / 1e9)
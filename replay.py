@@ -0,0 +1,260 @@
+#! /usr/bin/env python3
+# Replay client streams recorded by proxy.py --capture against a server.
+#
+# Every recorded connection is opened at its recorded offset from the start
+# of the capture, sends its client-to-server chunks at their recorded times
+# and half-closes where the client did; --speed scales the timing, and 0
+# replays as fast as possible (each chunk as soon as the previous one has
+# gone out).  Replies are read and compared byte for byte with what the
+# original server sent; connections whose replies differ are reported.  A
+# connection is closed where the proxy closed it, but not
+# before its replies are in, and at most --timeout seconds after the last
+# recorded event (at --speed 0: after the last progress).  Several capture
+# files (workers, restarts) are merged by timestamp.
+from collections import deque
+import glob
+from itertools import count
+import re
+from selectors import EVENT_READ, EVENT_WRITE, DefaultSelector
+from socket import SHUT_WR, socket
+import sys
+import time
+
+from capture import CLOSE, OPEN, readCapture
+from metrics import C2S, S2C
+import params
+
+switchesVarDefaults = (
+    (('-f', '--files'), 'files', "capture.*"),  # glob of capture files
+    (('-s', '--server'), 'server', "127.0.0.1:50001"),
+    (('-x', '--speed'), 'speed', "1"),  # timing multiplier; 0 = no waits
+    (('-t', '--timeout'), 'timeout', "10"),  # seconds to wait for replies
+    (('-d', '--debug'), 'debug', False),  # boolean (set if present)
+    (('-?', '--usage'), 'usage', False),  # boolean (set if present)
+    )
+
+paramMap = params.parseParams(switchesVarDefaults)
+if paramMap['usage']:
+    params.usage()
+debug = paramMap['debug']
+
+try:
+    serverHost, serverPort = re.split(":", paramMap['server'])
+    saddr = (serverHost, int(serverPort))
+except:
+    print(f"Can't parse server:port from {paramMap['server']}")
+    sys.exit(1)
+
+try:
+    speed = float(paramMap['speed'])
+    timeout = float(paramMap['timeout'])
+    assert speed >= 0 and timeout >= 0
+except:
+    print("Can't parse speed/timeout")
+    sys.exit(1)
+
+paths = sorted(glob.glob(paramMap['files']))
+if not paths:
+    print(f"No capture files match {paramMap['files']}")
+    sys.exit(1)
+
+sel = DefaultSelector()
+recvBuf = bytearray(1 << 16)    # replies are compared, then discarded
+recvView = memoryview(recvBuf)
+
+
+class Replayed:
+    """One recorded connection, driven from its recorded client stream"""
+    def __init__(self, name):
+        self.name = name
+        self.sock = None
+        self.out = deque()      # chunks due but not yet sent
+        self.eof = False        # half-close once out is sent
+        self.halfClosed = False
+        self.closing = False    # close once out is sent and replies are in
+        self.expected = 0       # bytes the original server sent
+        self.replies = deque()  # its chunks, still to be compared
+        self.replyOffset = 0    # bytes of replies[0] already compared
+        self.mismatchAt = None  # offset of the first differing reply byte
+        self.sent = self.received = 0
+        self.serverClosed = self.done = False
+        self.error = None
+
+    def open(self):
+        self.sock = sock = socket()
+        sock.setblocking(False)
+        sock.connect_ex(saddr)
+        sel.register(sock, EVENT_READ | EVENT_WRITE, self)
+
+    def send(self, data):
+        self.out.append(data)
+        self.updateInterest()
+
+    def updateInterest(self):
+        if self.done or self.sock is None:
+            return
+        sel.modify(self.sock, EVENT_READ | (EVENT_WRITE if self.out else 0),
+                   self)
+
+    def doSend(self):
+        while self.out:
+            try:
+                n = self.sock.send(self.out[0])
+            except BlockingIOError:
+                return
+            except OSError as e:
+                self.fail(f"can't send: {e}")
+                return
+            self.sent += n
+            if n < len(self.out[0]):
+                self.out[0] = self.out[0][n:]
+                return
+            self.out.popleft()
+        self.updateInterest()
+        self.checkDone()
+
+    def doRecv(self):
+        try:
+            n = self.sock.recv_into(recvBuf)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.fail(f"can't receive: {e}")
+            return
+        if n:
+            if self.mismatchAt is None:
+                self.compare(recvView[:n])
+            self.received += n
+        else:
+            self.serverClosed = True
+        self.checkDone()
+
+    def compare(self, data):    # data continues the reply stream at received
+        replies, pos = self.replies, 0
+        while pos < len(data):
+            if not replies:     # more than the original server sent
+                self.mismatch(pos)
+                return
+            chunk, offset = replies[0], self.replyOffset
+            k = min(len(chunk) - offset, len(data) - pos)
+            if data[pos:pos + k] != chunk[offset:offset + k]:
+                self.mismatch(pos + next(i for i in range(k)
+                                         if data[pos + i] != chunk[offset + i]))
+                return
+            pos += k
+            if offset + k == len(chunk):
+                replies.popleft()
+                self.replyOffset = 0
+            else:
+                self.replyOffset = offset + k
+
+    def mismatch(self, pos):
+        self.mismatchAt = self.received + pos
+        self.replies.clear()
+        if debug:
+            print(f"Connection {self.name}: reply differs at byte",
+                  self.mismatchAt)
+
+    def checkDone(self):
+        if self.out or self.done:
+            return
+        if self.eof and not self.halfClosed:
+            self.halfClosed = True
+            try:
+                self.sock.shutdown(SHUT_WR)
+            except OSError:
+                pass
+        if self.serverClosed or (
+                self.closing and self.received >= self.expected):
+            self.finish()
+
+    def fail(self, msg):
+        self.error = msg
+        if debug:
+            print(f"Connection {self.name} failed: {msg}")
+        self.finish()
+
+    def finish(self):
+        self.done = True
+        if self.sock is not None:
+            sel.unregister(self.sock)
+            self.sock.close()
+
+
+# merge every file's records into one timeline of client-side events
+conns = {}
+timeline = []                   # (when, seq, Replayed, kind, payload)
+seq = count()
+for fileIndex, path in enumerate(paths):
+    for when, connIndex, kind, payload in readCapture(path):
+        key = (fileIndex, connIndex)
+        conn = conns.get(key)
+        if conn is None:
+            conn = conns[key] = Replayed(f"{path}#{connIndex}")
+        if kind == S2C:
+            conn.expected += len(payload)
+            if payload:
+                conn.replies.append(payload)
+        else:
+            timeline.append((when, next(seq), conn, kind, payload))
+timeline.sort(key=lambda event: event[:2])
+if not timeline:
+    print("Nothing to replay")
+    sys.exit(0)
+
+first = timeline[0][0]
+start = time.monotonic()
+events = deque(timeline)
+while events:
+    when, i, conn, kind, payload = events[0]
+    due = start + (when - first) / speed if speed else start
+    now = time.monotonic()
+    if due > now:               # serve sockets until the next event
+        for key, mask in sel.select(due - now):
+            conn = key.data
+            if mask & EVENT_READ and not conn.done:
+                conn.doRecv()
+            if mask & EVENT_WRITE and not conn.done:
+                conn.doSend()
+        continue
+    events.popleft()
+    if conn.done:
+        continue
+    if kind == OPEN:
+        conn.open()
+    elif conn.sock is None:     # capture began mid-connection: skip it
+        conn.done = True
+    elif kind == C2S and payload:
+        conn.send(payload)
+    elif kind == C2S:           # the client half-closed
+        conn.eof = True
+        conn.checkDone()
+    elif kind == CLOSE:
+        conn.closing = True
+        conn.checkDone()
+
+deadline = time.monotonic() + timeout
+while sel.get_map() and time.monotonic() < deadline:
+    ready = sel.select(deadline - time.monotonic())
+    if ready and not speed:     # as fast as possible: wait for no progress
+        deadline = time.monotonic() + timeout
+    for key, mask in ready:
+        conn = key.data
+        if mask & EVENT_READ and not conn.done:
+            conn.doRecv()
+        if mask & EVENT_WRITE and not conn.done:
+            conn.doSend()
+elapsed = time.monotonic() - start
+
+incomplete = [c for c in conns.values() if c.sock and not c.done]
+for conn in incomplete:
+    conn.finish()
+failed = [c for c in conns.values() if c.error]
+differing = [c for c in conns.values() if c.mismatchAt is not None]
+print(f"Replayed {len(conns)} connections from {len(paths)} files in",
+      f"{elapsed:.2f}s: sent {sum(c.sent for c in conns.values())} bytes,",
+      f"received {sum(c.received for c in conns.values())} of",
+      f"{sum(c.expected for c in conns.values())} recorded reply bytes;",
+      f"{len(differing)} with differing replies,",
+      f"{len(incomplete)} timed out, {len(failed)} failed")
+sys.exit(1 if failed or incomplete else 0)
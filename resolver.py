@@ -0,0 +1,67 @@
+# Backend address cache, kept fresh off the event loop.
+#
+# Every backend is resolved once at startup; after that a daemon thread
+# re-resolves the ones named by hostname every ttl seconds and swaps in the
+# new record list, so Conns only ever read backend.addrs and never call
+# getaddrinfo.  A failed refresh keeps the stale records.  Numeric addresses
+# are resolved once and never refreshed.
+import os
+from socket import AI_NUMERICHOST, SOCK_STREAM, gaierror, getaddrinfo
+import threading
+import time
+
+from ringLog import log
+
+
+def lookup(host, port, flags=0):
+    """(family, sockaddr) records for host:port, duplicates removed"""
+    records = []
+    for family, socktype, proto, name, sockaddr in getaddrinfo(
+            host, port, type=SOCK_STREAM, flags=flags):
+        if (family, sockaddr) not in records:
+            records.append((family, sockaddr))
+    return records
+
+
+class Resolver:
+    def __init__(self, ttl=30.0):
+        self.ttl = ttl
+        self.dynamic = []       # backends named by hostname
+        self.thread, self.threadPid = None, None
+
+    def add(self, backend):
+        """Resolve backend now (may block: call before serving)"""
+        host, port = backend.saddr
+        try:
+            backend.setAddrs(lookup(host, port, AI_NUMERICHOST))
+            return              # a literal address never changes
+        except gaierror:
+            pass
+        self.dynamic.append(backend)
+        self.refresh(backend)
+
+    def refresh(self, backend):
+        host, port = backend.saddr
+        try:
+            records = lookup(host, port)
+        except OSError as e:
+            log.warning("Can't resolve backend %s: %s", backend, e)
+            return
+        if records != backend.addrs:
+            log.info("Backend %s resolves to %s", backend,
+                     ", ".join(str(sockaddr[0]) for family, sockaddr in records))
+            backend.setAddrs(records)
+
+    def start(self):
+        """Start refreshing in the background (again, if forked)"""
+        if self.dynamic and self.threadPid != os.getpid() and self.ttl > 0:
+            self.threadPid = os.getpid()
+            self.thread = threading.Thread(target=self.refreshLoop,
+                                           daemon=True, name="resolver")
+            self.thread.start()
+
+    def refreshLoop(self):
+        while True:
+            time.sleep(self.ttl)
+            for backend in self.dynamic:
+                self.refresh(backend)
@@ -0,0 +1,113 @@
+# Buffered logging that never blocks the event loop.
+#
+# Records are (time, level, format, args) tuples appended to an in-memory
+# ring; a writer thread formats and writes them in batches, so slow stdout
+# (or a slow consumer of it) only delays log output, never forwarding.
+# Connection-lifecycle records are sampled once the ring is half full and
+# dropped when it is full; warnings and errors are kept while there is room.
+# Dropped records are counted and reported by the writer.
+import atexit
+from collections import deque
+import os
+import sys
+import threading
+import time
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+levelNames = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+levelsByName = {name.lower(): level for level, name in levelNames.items()}
+
+
+class RingLog:
+    def __init__(self, capacity=10000, level=INFO, stream=None,
+                 flushInterval=0.05, batchSize=512):
+        self.capacity, self.level = capacity, level
+        self.stream = stream
+        self.flushInterval, self.batchSize = flushInterval, batchSize
+        self.ring = deque()
+        self.dropped = 0        # records discarded since last reported
+        self.sampleCount = 0
+        self.writer, self.writerPid = None, None
+        self.lock = threading.Lock()    # serializes writes to the stream
+
+    def configure(self, level=None, capacity=None):
+        if level is not None:
+            self.level = levelsByName[level] if isinstance(level, str) else level
+        if capacity is not None:
+            self.capacity = capacity
+
+    def isEnabled(self, level):
+        return level >= self.level
+
+    def add(self, level, fmt, args, sampled=False):
+        if level < self.level:
+            return
+        fill = len(self.ring)
+        if fill >= self.capacity:
+            self.dropped += 1
+            return
+        if sampled and fill >= self.capacity >> 1:
+            # keep 1 in 2**k lifecycle records, k growing as the ring fills
+            self.sampleCount += 1
+            k = 1 + 8 * (fill - (self.capacity >> 1)) // self.capacity
+            if self.sampleCount & ((1 << k) - 1):
+                self.dropped += 1
+                return
+        self.ring.append((time.time(), level, fmt, args))
+        if self.writerPid != os.getpid():   # first record (or forked)
+            self.startWriter()
+
+    def debug(self, fmt, *args):
+        self.add(DEBUG, fmt, args)
+
+    def info(self, fmt, *args):
+        self.add(INFO, fmt, args)
+
+    def conn(self, fmt, *args):         # connection lifecycle: may be sampled
+        self.add(INFO, fmt, args, True)
+
+    def warning(self, fmt, *args):
+        self.add(WARNING, fmt, args)
+
+    def error(self, fmt, *args):
+        self.add(ERROR, fmt, args)
+
+    def startWriter(self):
+        self.writerPid = os.getpid()
+        self.lock = threading.Lock()    # a forked child may inherit it held
+        self.writer = threading.Thread(target=self.writeLoop, daemon=True,
+                                       name="ringLog")
+        self.writer.start()
+
+    def writeLoop(self):
+        while True:
+            time.sleep(self.flushInterval)
+            self.flush()
+
+    def flush(self):
+        """Write out everything buffered so far (safe from any thread)"""
+        with self.lock:
+            ring, stream = self.ring, self.stream or sys.stdout
+            while ring or self.dropped:
+                lines = []
+                for i in range(min(self.batchSize, len(ring))):
+                    t, level, fmt, args = ring.popleft()
+                    try:
+                        msg = fmt % args if args else fmt
+                    except Exception as e:
+                        msg = f"{fmt!r} % {args!r} failed: {e}"
+                    stamp = time.strftime("%H:%M:%S", time.localtime(t))
+                    lines.append(f"{stamp}.{int(t % 1 * 1000):03d} "
+                                 f"{levelNames[level]} {msg}\n")
+                if self.dropped:
+                    dropped, self.dropped = self.dropped, 0
+                    lines.append(f"[log] {dropped} records dropped\n")
+                try:
+                    stream.write("".join(lines))
+                    stream.flush()
+                except (OSError, ValueError):
+                    pass        # nowhere to log to; keep draining
+
+
+log = RingLog()                 # shared instance used by the servers
+atexit.register(log.flush)
@@ -0,0 +1,56 @@
+# Named sets of socket options for one side (client or backend) of the proxy.
+#
+# "latency" turns off Nagle and delayed ACKs and keeps kernel buffers small,
+# so little data queues behind each message.  TCP_QUICKACK is not sticky
+# (the kernel goes back to delaying ACKs by itself), so a forwarder sets it
+# again after every read from a socket whose profile asks for it.
+# "throughput" asks for large buffers, caps the unsent data the kernel holds
+# (TCP_NOTSENT_LOWAT) so the large send buffer doesn't turn into latency,
+# and corks the socket while a forwarder has more data queued for it, so
+# bulk flows go out in full-sized segments.  Buffer sizes must be set
+# before connect()/listen() to affect the window scale, so they are applied
+# to listening sockets too.  Options this platform lacks are skipped.
+import socket
+from socket import IPPROTO_TCP, SO_RCVBUF, SO_SNDBUF, SOL_SOCKET
+
+profiles = {                    # name: (options, cork, quickAck)
+    "default": ((), False, False),
+    "latency": ((
+        (IPPROTO_TCP, "TCP_NODELAY", 1),
+        (SOL_SOCKET, "SO_SNDBUF", 65536),
+        (SOL_SOCKET, "SO_RCVBUF", 65536),
+        ), False, True),
+    "throughput": ((
+        (SOL_SOCKET, "SO_SNDBUF", 4 << 20),
+        (SOL_SOCKET, "SO_RCVBUF", 4 << 20),
+        (IPPROTO_TCP, "TCP_NOTSENT_LOWAT", 131072),
+        ), True, False),
+    }
+
+
+class SockOpts:
+    def __init__(self, name="default"):
+        if name not in profiles:
+            raise ValueError(f"unknown socket profile {name!r}"
+                             f" (profiles: {', '.join(profiles)})")
+        self.name = name
+        options, self.cork, self.quickAck = profiles[name]
+        self.options = [(level, getattr(socket, opt), value)
+                        for level, opt, value in options if hasattr(socket, opt)]
+        self.cork = self.cork and hasattr(socket, "TCP_CORK")
+        self.quickAck = self.quickAck and hasattr(socket, "TCP_QUICKACK")
+        self.buffers = [o for o in self.options if o[1] in (SO_SNDBUF, SO_RCVBUF)]
+
+    def apply(self, sock):
+        for level, opt, value in self.options:
+            try:
+                sock.setsockopt(level, opt, value)
+            except OSError:
+                pass            # e.g. TCP options on a non-TCP socket
+
+    def applyToListener(self, lsock):   # accepted sockets inherit these
+        for level, opt, value in self.buffers:
+            lsock.setsockopt(level, opt, value)
+
+    def __str__(self):
+        return self.name
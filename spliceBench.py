@@ -0,0 +1,98 @@
+#! /usr/bin/env python3
+# Bulk-transfer benchmark comparing proxy.py's userspace and --splice paths.
+# A source and a discarding sink run in this process; only the proxy's CPU
+# time (from /proc) is reported, so the numbers isolate the forwarding cost.
+import os
+from socket import (SHUT_WR, SO_REUSEADDR, SOL_SOCKET, create_connection,
+                    socket)
+import subprocess
+import sys
+import threading
+import time
+
+from benchProcs import cpuSeconds, here
+import params
+
+switchesVarDefaults = (
+    (('-m', '--megabytes'), 'megabytes', "1000"),
+    (('-b', '--bufCap'), 'bufCap', "262144"),  # proxy.py's default
+    (('-l', '--listenPort'), 'listenPort', "50100"),  # proxy under test
+    (('-p', '--sinkPort'), 'sinkPort', "50101"),
+    (('-?', '--usage'), 'usage', False),  # boolean (set if present)
+    )
+
+paramMap = params.parseParams(switchesVarDefaults)
+if paramMap['usage']:
+    params.usage()
+
+try:
+    megabytes = int(paramMap['megabytes'])
+    listenPort, sinkPort = int(paramMap['listenPort']), int(paramMap['sinkPort'])
+    bufCap = paramMap['bufCap']
+except:
+    print("Can't parse numeric parameters")
+    sys.exit(1)
+
+proxyPath = os.path.join(here, "proxy.py")
+
+
+def sink(lsock, received):      # accept one connection and discard it all
+    csock, caddr = lsock.accept()
+    buf = bytearray(1 << 20)
+    n = 1
+    while n:
+        n = csock.recv_into(buf)
+        received[0] += n
+    csock.close()
+
+
+def runOnce(extraArgs):
+    lsock = socket()
+    lsock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    lsock.bind(("127.0.0.1", sinkPort))
+    lsock.listen(1)
+    proxy = subprocess.Popen(
+        [sys.executable, proxyPath, "-l", str(listenPort),
+         "-s", f"127.0.0.1:{sinkPort}", "-b", bufCap] + extraArgs,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for attempt in range(50):   # wait for the proxy to listen
+            try:
+                ssock = create_connection(("127.0.0.1", listenPort))
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.1)
+        else:
+            raise RuntimeError("proxy did not start")
+        received = [0]
+        sinkThread = threading.Thread(target=sink, args=(lsock, received))
+        sinkThread.start()
+        chunk = memoryview(os.urandom(1 << 20))
+        cpuBefore, start = cpuSeconds(proxy.pid), time.monotonic()
+        for i in range(megabytes):
+            ssock.sendall(chunk)
+        ssock.shutdown(SHUT_WR)
+        sinkThread.join()
+        elapsed = time.monotonic() - start
+        cpu = cpuSeconds(proxy.pid) - cpuBefore
+        ssock.close()
+    finally:
+        proxy.terminate()
+        proxy.wait()
+        lsock.close()
+    if received[0] != megabytes << 20:
+        print(f"Warning: sink got {received[0]} bytes, expected {megabytes << 20}")
+    return elapsed, cpu
+
+
+print(f"Forwarding {megabytes} MiB through proxy.py (bufCap={bufCap})")
+results = {}
+for mode, extraArgs in (("userspace", []), ("splice", ["--splice"])):
+    elapsed, cpu = runOnce(extraArgs)
+    results[mode] = cpu
+    print(
+        f"{mode:>10}: {elapsed:6.2f}s wall, {megabytes / elapsed:8.1f} MiB/s,",
+        f"proxy cpu {cpu:6.2f}s ({cpu * 1024 / megabytes:.3f}s per GiB)",
+        )
+if results["userspace"] > 0:
+    print(f"splice/userspace proxy CPU = {results['splice'] / results['userspace']:.2f}")
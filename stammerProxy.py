@@ -1,18 +1,23 @@
 #! /usr/bin/env python3
 import re
-import random
-from select import select
-from socket import (AF_INET, SHUT_WR, SO_REUSEADDR, SOCK_STREAM, SOL_SOCKET,
-                    socket)
+import signal
 import sys
-import time
-import traceback
 
+from linkShape import LinkProfile, LinkShaper, presets, rngFor
+from metrics import C2S, S2C
 import params
+from ringLog import log
+import reactor
 
 switchesVarDefaults = (
     (('-l', '--listenPort'), 'listenPort', 50000),
     (('-s', '--server'), 'server', "127.0.0.1:50001"),
+    (('-c', '--connectTimeout'), 'connectTimeout', "10"),  # seconds; 0=none
+    (('-i', '--idleTimeout'), 'idleTimeout', "0"),  # seconds; 0=none
+    (('-p', '--profile'), 'profile', "stammer"),  # link profile, both ways
+    (('-u', '--upProfile'), 'upProfile', "same"),  # client to server
+    (('-w', '--downProfile'), 'downProfile', "same"),  # server to client
+    (('-r', '--seed'), 'seed', "none"),  # make shaping reproducible
     (('-d', '--debug'), 'debug', False),  # boolean (set if present)
     (('-?', '--usage'), 'usage', False),  # boolean (set if present)
     )
@@ -39,231 +44,47 @@ except:
     print(f"Can't parse listen port from {listenPort}")
     sys.exit(1)
 
+try:
+    connectTimeout = float(paramMap['connectTimeout'])
+    idleTimeout = float(paramMap['idleTimeout'])
+    assert connectTimeout >= 0 and idleTimeout >= 0
+except:
+    print("Can't parse connect/idle timeouts")
+    sys.exit(1)
 
-sockNames = {}            # from socket to name
-nextConnectionNumber = 0  # each connection is assigned a unique id
-
-now = time.time()
-
-
-class Fwd:
-    def __init__(self, conn, inSock, outSock, bufCap=1000):
-        global now, xmap
-        self.inSock, self.outSock = inSock, outSock
-        self.conn, self.bufCap = conn, bufCap
-        self.inClosed, self.buf = 0, b""
-        self.delaySendUntil = 0  # no delay
-
-    def checkRead(self):
-        if len(self.buf) < self.bufCap and not self.inClosed:
-            return self.inSock
-        else:
-            return None
-
-    def checkWrite(self):
-        if len(self.buf) > 0 and now >= self.delaySendUntil:
-            return self.outSock
-        else:
-            return None
-
-    def doRecv(self):
-        b = b""
-        try:
-            b = self.inSock.recv(self.bufCap - len(self.buf))
-        except:
-            self.conn.die()
-        if len(b):
-            self.buf += b
-        else:
-            self.inClosed = 1
-        self.checkDone()
-
-    def doSend(self):
-        global now
-        try:
-            bufLen = len(self.buf)
-            # attempt to send random-length fragment from beginning of buffer
-            toSend = random.randrange(1, bufLen+1)
-            if debug:
-                print(f"Attempting to send {toSend} of {len(self.buf)}")
-            n = self.outSock.send(self.buf[0:toSend])
-            self.buf = self.buf[n:] # delete the fragment that was successfully enqueued for transmission
-            if len(self.buf):
-                self.delaySendUntil = now + 0.1
-        except Exception as e:
-            print(e)
-            self.conn.die()
-        self.checkDone()
-
-    def checkDone(self):
-        if len(self.buf) == 0 and self.inClosed:
-            try:
-                self.outSock.shutdown(SHUT_WR)
-            except Exception as e:
-                print(f"Shutting down {self.outSock} for writing: {e}")
-
-    def doErr(self, sock):
-        if sock == self.inSock:
-            if not self.inClosed:
-                print(
-                    f"Forwarder notified that input socket {sockNames[sock]}",
-                    "died prior to shutdown!",
-                    )
-                self.inClosed = True
-            if len(self.buf) != 0:
-                if debug:
-                    print(
-                        "[Info] Forwarder notified that input socket",
-                        f"{sockNames[self.inSock]} died, still draining",
-                        f"to {sockNames[self.outSock]}",
-                        )
-            self.checkDone()
-
-        else:                   # outsock
-            if len(self.buf) != 0:
-                print(
-                    f"Forwarder's outSock {sockNames[self.outSock]} died",
-                    "prior to draining data from",
-                    f"inSock {sockNames[self.inSock]}",
-                    )
-                self.buf = b""  # clear output buffer (nothing more to send)
-            elif not self.inClosed:
-                if debug:
-                    print(
-                        f"[Info] Forwarder's outSock {sockNames[self.outSock]}",
-                        f"died before its inSock {sockNames[self.inSock]}",
-                        "shutdown",
-                        )
-            try:
-                self.outSock.shutdown(SHUT_WR)
-            except Exception as e:
-                print(f"Shutting down {self.outSock} for writing: {e}")
-            self.conn.fwdDone(self)
-
-
-connections = set()
-
-
-class Conn:
-    def __init__(self, csock, caddr, af, socktype, saddr):
-        global nextConnectionNumber
-        self.csock = csock      # to client
-        self.caddr, self.saddr = caddr, saddr  # addresses
-        self.connIndex = connIndex = nextConnectionNumber
-        nextConnectionNumber += 1
-        self.ssock = ssock = socket(af, socktype)
-        self.forwarders = forwarders = set()
-        print(f"New connection #{connIndex} from {caddr}")
-        sockNames[csock] = f"ToClnt.{connIndex}"
-        sockNames[ssock] = f"ToSrvr.{connIndex}"
-        ssock.setblocking(False)
-        ssock.connect_ex(saddr)
-        forwarders.add(Fwd(self, csock, ssock))
-        forwarders.add(Fwd(self, ssock, csock))
-        connections.add(self)
-
-    def fwdDone(self, forwarder):
-        forwarders = self.forwarders
-        forwarders.remove(forwarder)
-        print(
-            f"Forwarder {sockNames[forwarder.inSock]} ==>",
-            f"{sockNames[forwarder.outSock]} from connection",
-            f"{self.connIndex} shutting down",
-            )
-        if len(forwarders) == 0:
-            self.die()
-
-    def die(self):
-        print(f"Connection {self.connIndex} shutting down")
-        for s in self.ssock, self.csock:
-            del sockNames[s]
-            try:
-                s.close()
-            except:
-                pass
-        connections.remove(self)
-
-    def doErr(self, sock):
-        for f in self.forwarders:
-            f.doErr(sock)
-
-        print(f"Forwarder from client {self.caddr} failing due to error")
-        self.die()
-
-
-class Listener:
-    def __init__(self, bindaddr, saddr, addrFamily=AF_INET,
-                 socktype=SOCK_STREAM):  # saddr is address of server
-        self.bindaddr, self.saddr = bindaddr, saddr
-        self.addrFamily, self.socktype = addrFamily, socktype
-        self.lsock = lsock = socket(addrFamily, socktype)
-        sockNames[lsock] = "listener"
-        lsock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-        lsock.bind(bindaddr)
-        lsock.setblocking(False)
-        lsock.listen(2)
-
-    def doRecv(self):
-        try:
-            csock, caddr = self.lsock.accept()  # socket connected to client
-            Conn(csock, caddr, self.addrFamily, self.socktype, self.saddr)
-        except:
-            print("Weird, listener readable but can't accept!")
-            traceback.print_exc(file=sys.stdout)
-
-    def doErr(self):
-        print("Listener socket failed!")
-        sys.exit(2)
-
-    def checkRead(self):
-        return self.lsock
-
-    def checkWrite(self):
-        return None
+try:
+    profiles = {}               # direction -> LinkProfile
+    for direction in "up", "down":
+        spec = paramMap[direction + 'Profile']
+        profiles[direction] = LinkProfile(
+            paramMap['profile'] if spec == "same" else spec)
+except ValueError as e:
+    print(f"Can't parse link profile: {e} (presets: {', '.join(presets)})")
+    sys.exit(1)
+seed = None if paramMap['seed'] == "none" else paramMap['seed']
 
-    def checkErr(self):
-        return self.lsock
+log.configure(level="debug" if debug else "info")
+reactor.configure(connectTimeout=connectTimeout, idleTimeout=idleTimeout)
 
 
-l = Listener(("0.0.0.0", listenPort), (serverHost, serverPort))
+class Conn(reactor.Conn):
+    __slots__ = ()
 
+    def __init__(self, csock, caddr, listener):
+        super().__init__(csock, caddr, listener)
+        log.conn("New connection #%d from %s", self.connIndex, caddr)
+        self.connect((serverHost, serverPort))
+        for inSock, outSock, direction, name in (
+                (csock, self.ssock, C2S, "up"), (self.ssock, csock, S2C, "down")):
+            profile = profiles[name]
+            filters = None      # unshaped: plain forwarding
+            if profile.shaped:
+                filters = [LinkShaper(profile,
+                                      rngFor(seed, self.connIndex, name))]
+            self.forward(inSock, outSock, direction, filters, profile.bufCap)
 
-def lookupSocknames(socks):
-    return [sockNames[s] for s in socks]
 
-while 1:
-    rmap, wmap, xmap = {}, {}, {}   # socket:object mappings for select
-    xmap[l.checkErr()] = l
-    rmap[l.checkRead()] = l
-    now = time.time()
-    nextDelayUntil = now + 10   # default 10s poll
-    for conn in connections:
-        for sock in conn.csock, conn.ssock:
-            xmap[sock] = conn
-            for fwd in conn.forwarders:
-                sock = fwd.checkRead()
-                if (sock):
-                    rmap[sock] = fwd
-                sock = fwd.checkWrite()
-                if (sock):
-                    wmap[sock] = fwd
-                delayUntil = fwd.delaySendUntil
-                if (delayUntil < nextDelayUntil and delayUntil > now):
-                    # minimum active delay
-                    nextDelayUntil = delayUntil
-    delay = nextDelayUntil - now
-    if debug:
-        print(f"delay={delay}")
-    rset, wset, xset = select(list(rmap.keys()), list(wmap.keys()),
-                              list(xmap.keys()), delay)
-    if debug:
-        print(
-            "ready sockets: ",
-            [[sockNames[s] for s in sset] for sset in [rset, wset, xset]]
-            )
-    for sock in rset:
-        rmap[sock].doRecv()
-    for sock in wset:
-        wmap[sock].doSend()
-    for sock in xset:
-        xmap[sock].doErr(sock)
+reactor.Listener(("0.0.0.0", listenPort), Conn)
+# on SIGTERM run() returns, so buffered log records get flushed at exit
+reactor.onSignal(signal.SIGTERM, reactor.stop)
+reactor.run(10)
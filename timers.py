@@ -0,0 +1,77 @@
+# Timer heap shared by the event-loop servers.
+#
+# schedule() is O(log n) and cancel() is O(1): a cancelled timer stays in the
+# heap and is skipped when it reaches the top, and the heap is rebuilt once
+# cancelled entries outnumber live ones.  Handlers that are "touched" on
+# every I/O (idle timeouts) should not reschedule per event; instead they
+# record the time of the last activity and, when the timer fires, re-arm it
+# for the remaining time.  The loop's notion of now is cached in `now` so
+# hot paths can timestamp activity without a system call.
+import heapq
+from itertools import count
+import time
+
+now = time.monotonic()          # refreshed by runDue() on every wakeup
+
+
+class Timer:
+    __slots__ = ("when", "seq", "callback", "cancelled", "queue")
+
+    def __init__(self, when, seq, callback, queue):
+        self.when, self.seq, self.callback = when, seq, callback
+        self.cancelled, self.queue = False, queue
+
+    def __lt__(self, other):
+        return (self.when, self.seq) < (other.when, other.seq)
+
+    def cancel(self):
+        if not self.cancelled:
+            self.cancelled = True
+            self.queue.cancelled += 1
+
+
+class TimerQueue:
+    def __init__(self):
+        self.heap = []
+        self.cancelled = 0      # cancelled timers still in the heap
+        self.seq = count()      # keeps equal deadlines in scheduling order
+
+    def __len__(self):
+        return len(self.heap) - self.cancelled
+
+    def scheduleAt(self, when, callback):
+        """Call callback() once time.monotonic() reaches when"""
+        timer = Timer(when, next(self.seq), callback, self)
+        heapq.heappush(self.heap, timer)
+        return timer
+
+    def schedule(self, delay, callback):
+        return self.scheduleAt(now + delay, callback)
+
+    def timeout(self, default=None):
+        """Seconds until the next live timer (at most default), for select"""
+        heap = self.heap
+        while heap and heap[0].cancelled:
+            heapq.heappop(heap)
+            self.cancelled -= 1
+        if not heap:
+            return default
+        wait = max(heap[0].when - time.monotonic(), 0)
+        return wait if default is None else min(wait, default)
+
+    def runDue(self):
+        """Refresh now and run every timer whose deadline has passed"""
+        global now
+        now = time.monotonic()
+        heap = self.heap
+        while heap and heap[0].when <= now:
+            timer = heapq.heappop(heap)
+            if timer.cancelled:
+                self.cancelled -= 1
+                continue
+            timer.cancelled = True      # fired: cancel() becomes a no-op
+            timer.callback()
+        if self.cancelled > 64 and self.cancelled > len(heap) >> 1:
+            self.heap = [t for t in heap if not t.cancelled]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
@@ -0,0 +1,71 @@
+# Pre-fork supervisor: run several copies of a server, one per core.
+#
+# Each worker binds its own listening socket with SO_REUSEPORT so the kernel
+# spreads incoming connections across them.  The supervisor restarts workers
+# that die and forwards SIGTERM/SIGINT to all of them on shutdown.
+import os
+import signal
+import sys
+import time
+
+restartDelay = 1.0              # minimum seconds between restarts of a worker
+
+
+def forkWorkers(numWorkers):
+    """Fork numWorkers workers and supervise them until told to stop.
+
+    Returns the worker's index (0..numWorkers-1) in each worker process; the
+    supervisor itself never returns.  Call this before creating selectors,
+    threads or sockets that must not be shared between workers."""
+    workers = {}                # from pid to worker index
+    lastStart = {}              # from worker index to start time
+    stopping = []
+
+    def spawn(index):
+        sys.stdout.flush()      # or the worker would repeat buffered output
+        pid = os.fork()
+        if pid == 0:            # worker: default signals, run the server
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            return True
+        workers[pid] = index
+        lastStart[index] = time.monotonic()
+        print(f"Worker {index} started as pid {pid}")
+        return False
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for index in range(numWorkers):
+        if spawn(index):
+            return index
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        index = workers.pop(pid, None)
+        if index is None:
+            continue
+        if stopping:
+            continue
+        print(f"Worker {index} (pid {pid}) exited with status {status},",
+              "restarting")
+        wait = lastStart[index] + restartDelay - time.monotonic()
+        if wait > 0:            # don't spin on a worker that can't start
+            time.sleep(wait)
+        if stopping:
+            continue
+        if spawn(index):
+            return index
+    sys.exit(0)